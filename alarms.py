@@ -0,0 +1,157 @@
+'''
+Alarms evaluated on the controller state stream.
+
+Each rule names the state fields it depends on and is only evaluated when one
+of them changes, or while it is waiting out a hold time or is active, so an
+update costs time in proportion to the rules it touches. An alarm has to hold
+for `hold` seconds before it is raised and its clear condition has to hold for
+`clear_hold` seconds before it clears. Having a separate clear condition gives
+hysteresis, and an alarm is only reported once until it clears.
+'''
+
+import os
+import subprocess
+
+
+# Distinguishes "never seen" from a field that is None
+MISSING = object()
+
+
+class Rule(object):
+    '''
+    test and clear are called with the state. clear defaults to the test not
+    passing. message is formatted with the state when the alarm is raised.
+    '''
+    def __init__(self, name, fields, test, message, clear=None, hold=0, clear_hold=0):
+        self.Name = name
+        self.Fields = fields
+        self.Test = test
+        self.Clear = clear
+        self.Message = message
+        self.Hold = hold
+        self.ClearHold = clear_hold
+
+    def clears(self, state):
+        if self.Clear is not None:
+            return self.Clear(state)
+        return not self.Test(state)
+
+
+class Alarm(object):
+    def __init__(self, rule, message, since):
+        self.Name = rule.Name
+        self.Message = message
+        self.Since = since
+
+
+def defaultRules(temp_threshold, out_of_band_time=60):
+    def outOfBand(s):
+        return s['running'] and not s['warming_up'] and abs(s['temperature'] - s['setpoint']) > temp_threshold
+
+    return [
+        Rule('out_of_band', ('temperature', 'setpoint', 'running', 'warming_up'), outOfBand,
+             "Temperature %(temperature).1f F out of band", hold=out_of_band_time, clear_hold=30),
+        Rule('hot_maxed', ('hot', 'cold', 'temperature', 'setpoint', 'running'),
+             lambda s: s['running'] and s['hot'] >= 100 and s['cold'] <= 0 and s['temperature'] < s['setpoint'],
+             "Hot is maxed out", hold=30),
+        Rule('cold_maxed', ('hot', 'cold', 'temperature', 'setpoint', 'running'),
+             lambda s: s['running'] and s['cold'] >= 100 and s['hot'] <= 0 and s['temperature'] > s['setpoint'],
+             "COLD is maxed out", hold=30),
+        Rule('serial_slow', ('rtt',), lambda s: s['rtt'] > 0.5,
+             "Serial round trip %(rtt).2fs", clear=lambda s: s['rtt'] < 0.25, hold=10),
+        # Age (seconds) of the oldest point waiting for Influx. The queue is
+        # capped, so its length says little once uploads have stopped.
+        Rule('telemetry_backlog', ('backlog',), lambda s: s['backlog'] > 15*60,
+             "Telemetry %(backlog)ds behind", clear=lambda s: s['backlog'] < 5*60),
+        Rule('command_failed', ('last_failure',), lambda s: s['time'] - s['last_failure'] < 60,
+             "Arduino command failed"),
+        Rule('serial_reset', ('last_reset',), lambda s: s['time'] - s['last_reset'] < 5*60,
+             "Serial connection was reset"),
+    ]
+
+
+def commandNotifier(command):
+    '''
+    Notifier that runs a shell command with the alarm in the environment,
+    ie to send a message somewhere
+    '''
+    def notify(alarm, raised):
+        env = dict(os.environ, ALARM_NAME=alarm.Name, ALARM_MESSAGE=alarm.Message,
+                   ALARM_STATE="raised" if raised else "cleared")
+        subprocess.Popen(command, shell=True, env=env)
+    return notify
+
+
+class AlarmEngine(object):
+    def __init__(self, log, rules):
+        self.Log = log
+        self.Rules = rules
+        # field -> rules that depend on it
+        self.Index = {}
+        for rule in rules:
+            for field in rule.Fields:
+                self.Index.setdefault(field, []).append(rule)
+        self.Order = dict((rule, x) for x, rule in enumerate(rules))
+        self.Last = {}
+        # Rules waiting out a hold time or active, these are evaluated on
+        # every update
+        self.Pending = set()
+        # rule -> when its raise (or while active, clear) condition started
+        self.Since = {}
+        # name -> Alarm
+        self.Active = {}
+        # Called with (alarm, raised) when an alarm is raised or cleared
+        self.Notifiers = []
+
+    def addNotifier(self, notifier):
+        self.Notifiers.append(notifier)
+
+    def messages(self):
+        return [alarm.Message for alarm in list(self.Active.values())]
+
+    def update(self, state):
+        touched = set(self.Pending)
+        for field, value in state.items():
+            if self.Last.get(field, MISSING) != value:
+                self.Last[field] = value
+                touched.update(self.Index.get(field, ()))
+
+        for rule in sorted(touched, key=self.Order.get):
+            try:
+                self.evaluate(rule, state, state['time'])
+            except Exception as e:
+                self.Log.error("Alarm rule %s failed: %s" % (rule.Name, e))
+
+    def evaluate(self, rule, state, now):
+        alarm = self.Active.get(rule.Name)
+        if alarm is None:
+            if not rule.Test(state):
+                self.Since.pop(rule, None)
+                self.Pending.discard(rule)
+                return
+            self.Pending.add(rule)
+            if now - self.Since.setdefault(rule, now) >= rule.Hold:
+                del self.Since[rule]
+                alarm = Alarm(rule, rule.Message % state, now)
+                self.Active[rule.Name] = alarm
+                self.notify(alarm, True)
+        else:
+            if not rule.clears(state):
+                self.Since.pop(rule, None)
+                return
+            if now - self.Since.setdefault(rule, now) >= rule.ClearHold:
+                del self.Since[rule]
+                del self.Active[rule.Name]
+                self.Pending.discard(rule)
+                self.notify(alarm, False)
+
+    def notify(self, alarm, raised):
+        if raised:
+            self.Log.error("ALARM: %s" % alarm.Message)
+        else:
+            self.Log.info("Alarm cleared: %s" % alarm.Message)
+        for notifier in self.Notifiers:
+            try:
+                notifier(alarm, raised)
+            except Exception as e:
+                self.Log.error("Alarm notifier failed: %s" % (e), exc_info=1)
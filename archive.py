@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+'''
+Local archive of controller samples, so past runs can be looked at without
+Influx or the network.
+
+Samples are stored by column, one file per column per hour, as the raw bytes
+of an array. The hours that exist are the sparse time index, and as the time
+column within an hour is sorted a time range is found by bisection, so any
+hour of data is a handful of small file reads.
+
+    python3 archive.py [hours]     # summarise the runs in the last 24 hours
+'''
+
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+
+
+ARCHIVE_DIR = os.path.expanduser("~/.irrigation-archive")
+PARTITION = 60*60
+# Samples are buffered and written in batches (about a minute)
+FLUSH_SAMPLES = 60
+COLUMNS = (
+    ('time', 'd'),
+    ('temperature', 'f'),
+    ('hot', 'f'),
+    ('cold', 'f'),
+    ('output', 'B'),
+    ('recycle', 'B'),
+    ('running', 'B'),
+)
+
+
+class Archive(object):
+    def __init__(self, log, path=ARCHIVE_DIR):
+        self.Log = log
+        self.Path = path
+        os.makedirs(self.Path, exist_ok=True)
+        # Hours (since the epoch) that have data on disk, sorted
+        self.Partitions = sorted(int(name.split('.')[0]) for name in os.listdir(self.Path)
+                                 if name.endswith('.time'))
+        self.Buffer = dict((name, array(code)) for name, code in COLUMNS)
+        self.BufferPartition = None
+        # Hours whose columns are known to line up, so they can be appended to
+        self.Aligned = set()
+        self.Lock = threading.Lock()
+
+    def _file(self, partition, name):
+        return os.path.join(self.Path, "%d.%s" % (partition, name))
+
+    def add(self, state):
+        '''
+        TempControl listener
+        '''
+        partition = int(state['time']//PARTITION)
+        with self.Lock:
+            if self.BufferPartition is not None and partition != self.BufferPartition:
+                self._flush()
+            self.BufferPartition = partition
+            for name, code in COLUMNS:
+                self.Buffer[name].append(state[name])
+            if len(self.Buffer['time']) >= FLUSH_SAMPLES:
+                self._flush()
+
+    def flush(self):
+        with self.Lock:
+            self._flush()
+
+    def _align(self, partition):
+        '''
+        Cut the columns of an hour back to the rows they all have. The
+        columns are written one at a time, so a crash part way through a
+        flush leaves them different lengths, and anything appended after
+        that would be paired with the wrong rows.
+        '''
+        files = []
+        for name, code in COLUMNS:
+            path = self._file(partition, name)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                size = 0
+            files.append((path, size, array(code).itemsize))
+        rows = min(size//itemsize for path, size, itemsize in files)
+        for path, size, itemsize in files:
+            if size != rows*itemsize:
+                self.Log.error("Truncating %s to %d rows after an incomplete write" % (path, rows))
+                with open(path, "r+b") as f:
+                    f.truncate(rows*itemsize)
+        self.Aligned.add(partition)
+
+    def _flush(self):
+        if not self.Buffer['time']:
+            return
+        try:
+            if self.BufferPartition not in self.Aligned:
+                self._align(self.BufferPartition)
+            for name, code in COLUMNS:
+                with open(self._file(self.BufferPartition, name), "ab") as f:
+                    f.write(self.Buffer[name].tobytes())
+        except Exception as e:
+            self.Log.error("Failed to write the archive: %s" % (e))
+            # Some of the columns may have been written
+            self.Aligned.discard(self.BufferPartition)
+        if self.BufferPartition not in self.Partitions:
+            bisect.insort(self.Partitions, self.BufferPartition)
+        for name, code in COLUMNS:
+            del self.Buffer[name][:]
+
+    def load(self, partition):
+        '''
+        All the columns of an hour
+        '''
+        columns = {}
+        for name, code in COLUMNS:
+            column = array(code)
+            with open(self._file(partition, name), "rb") as f:
+                data = f.read()
+            # A crash part way through a write can leave a partial value
+            column.frombytes(data[:len(data) - len(data) % column.itemsize])
+            columns[name] = column
+        # and the columns different lengths
+        length = min(len(column) for column in columns.values())
+        if length < len(columns['time']):
+            columns = dict((name, column[:length]) for name, column in columns.items())
+        return columns
+
+    def query(self, start, end):
+        '''
+        Samples with start <= time < end as {column: [values, ...]}
+        '''
+        result = dict((name, []) for name, code in COLUMNS)
+
+        def extend(columns):
+            times = columns['time']
+            low = bisect.bisect_left(times, start)
+            high = bisect.bisect_left(times, end)
+            for name in result:
+                result[name].extend(columns[name][low:high])
+
+        with self.Lock:
+            first = bisect.bisect_left(self.Partitions, int(start//PARTITION))
+            partitions = [p for p in self.Partitions[first:] if p*PARTITION < end]
+            for partition in partitions:
+                try:
+                    extend(self.load(partition))
+                except Exception as e:
+                    self.Log.error("Failed to read archive hour %d: %s" % (partition, e))
+            # Not written yet, and always newer than what is on disk
+            extend(self.Buffer)
+        return result
+
+    def runs(self, start, end):
+        '''
+        Summary of each run (samples with the controller running) in the range
+        '''
+        samples = self.query(start, end)
+        runs = []
+        current = None
+        for t, temp, hot, cold, output, running in zip(samples['time'], samples['temperature'],
+                                                        samples['hot'], samples['cold'],
+                                                        samples['output'], samples['running']):
+            if not running:
+                if current is not None:
+                    runs.append(current)
+                    current = None
+                continue
+            if current is None:
+                current = {'start': t, 'samples': 0, 'min_temperature': temp, 'max_temperature': temp,
+                           'mean_temperature': 0.0, 'mean_hot': 0.0, 'mean_cold': 0.0, 'output': 0.0}
+            current['end'] = t
+            current['samples'] += 1
+            current['min_temperature'] = min(current['min_temperature'], temp)
+            current['max_temperature'] = max(current['max_temperature'], temp)
+            # Running means, so there is nothing to finish off at the end
+            n = current['samples']
+            current['mean_temperature'] += (temp - current['mean_temperature'])/n
+            current['mean_hot'] += (hot - current['mean_hot'])/n
+            current['mean_cold'] += (cold - current['mean_cold'])/n
+            current['output'] += (output - current['output'])/n
+        if current is not None:
+            runs.append(current)
+        return runs
+
+
+if __name__ == "__main__":
+    log = logging.getLogger('ArchiveLogger')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    end = time.time()
+    archive = Archive(log)
+    start_time = time.time()
+    runs = archive.runs(end - hours*PARTITION, end)
+    log.info("%d runs in the last %g hours (%.1f ms)" % (len(runs), hours, (time.time() - start_time)*1000))
+    for run in runs:
+        log.info("%s  %6.1f min  temp %.1f F (%.1f - %.1f)  hot %.0f%%  cold %.0f%%  output %.0f%%" %
+                 (time.strftime('%Y-%m-%d %H:%M', time.localtime(run['start'])),
+                  (run['end'] - run['start'])/60.0, run['mean_temperature'],
+                  run['min_temperature'], run['max_temperature'],
+                  run['mean_hot'], run['mean_cold'], run['output']*100))
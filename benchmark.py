@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+'''
+Render loop benchmark.
+
+Runs the App headless with SDL's dummy video driver, the FakeSerial Arduino
+(or a serial recording, see recording.py) and a stand-in for the Influx data
+source. Reports p50/p99 frame and per-widget render times along with the
+memory blocks allocated per frame, and exits non-zero if the p99 frame time
+is over budget.
+
+    python3 benchmark.py [frames per screen] [p99 budget in ms]
+'''
+
+import os
+import sys
+import tempfile
+
+# Set up before pygame is imported. The App's config and journal files are
+# kept out of the real home directory.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ["HOME"] = tempfile.mkdtemp(prefix="irrigation-benchmark-")
+os.environ.pop("PRODUCTION", None)
+os.environ["DASHBOARD_PORT"] = "0"
+
+import gc
+import logging
+import threading
+import time
+
+import pygame
+from pygame.locals import *
+
+import data
+import gui
+
+
+FRAMES = 300
+# Leave room for the frame rate the App asks for
+FRAME_BUDGET_MS = 1000.0/gui.FRAME_RATE
+STARTUP_TIMEOUT = 30
+
+
+class StubDataSource(object):
+    '''
+    Stands in for data.DataSource so no Influx server is needed
+    '''
+    def __init__(self, log):
+        self.Log = log
+        self.Points = []
+        self.Wakeup = threading.Event()
+
+    def getCached(self, name):
+        return {'bench': 70.0}
+
+    def prefetch(self):
+        pass
+
+    def nextPrefetch(self):
+        return 60
+
+    def addSample(self, measurement, fields, tags=None, t=None):
+        pass
+
+    def flushSamples(self):
+        pass
+
+    def backlog(self, now=None):
+        return 0
+
+    def writePoints(self):
+        self.Points = []
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered)*fraction), len(ordered) - 1)]
+
+
+class Benchmark(object):
+    def __init__(self, log, app):
+        self.Log = log
+        self.App = app
+        # name -> [seconds, ...] for the frames being measured
+        self.Times = {}
+        # Time spent in the components that the App calls directly, so the
+        # rest of the frame can be reported as unattributed
+        self.Attributed = 0.0
+
+    def timed(self, name, func, nested=False):
+        '''
+        nested components are drawn by another timed component, and are
+        already part of its time
+        '''
+        times = self.Times.setdefault(name, [])
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                times.append(elapsed)
+                if not nested:
+                    self.Attributed += elapsed
+        return wrapper
+
+    def instrument(self):
+        # Instance attributes shadow the methods, so the App calls these
+        app = self.App
+        widgets = [
+            ('TempControl', app.TempController, False),
+            ('HotValve', app.TempController.HotValve, True),
+            ('ColdValve', app.TempController.ColdValve, True),
+            ('Sparkline', app.TempController.Sparkline, True),
+            ('TrendChart', app.TempController.Chart, True),
+            ('Settings', app.Settings, False),
+            ('TimerControl', app.TimerControl, False),
+            ('StartStop', app.StartStop, False),
+            ('PowerButton', app.PowerButton, False),
+            ('SettingsButton', app.SettingsButton, False),
+            ('AlarmBanner', app.AlarmBanner, False),
+            ('DebugOverlay', app.DebugOverlay, False),
+        ]
+        for name, widget, nested in widgets:
+            widget.render = self.timed(name, widget.render, nested)
+        app.renderBackground = self.timed('Background', app.renderBackground)
+        app.renderClimate = self.timed('Climate', app.renderClimate)
+        app.debugLines = self.timed('DebugLines', app.debugLines)
+        app.handleEvents = self.timed('Events', app.handleEvents)
+        pygame.display.flip = self.timed('flip', pygame.display.flip)
+
+    def waitForWorker(self):
+        while self.App.Worker.depth() or self.App.Worker.Busy:
+            time.sleep(0.01)
+
+    def measure(self, screen, frames):
+        for times in self.Times.values():
+            del times[:]
+        frame_times = []
+        unattributed = []
+        blocks = []
+        collections = sum(s['collections'] for s in gc.get_stats())
+
+        for x in range(frames):
+            allocated = sys.getallocatedblocks()
+            self.Attributed = 0.0
+            start = time.perf_counter()
+            if not self.App.frame():
+                break
+            frame_times.append(time.perf_counter() - start)
+            unattributed.append(frame_times[-1] - self.Attributed)
+            blocks.append(sys.getallocatedblocks() - allocated)
+
+        collections = sum(s['collections'] for s in gc.get_stats()) - collections
+        self.Log.info("%s: %d frames, %d gc collections" % (screen, len(frame_times), collections))
+        self.report("frame", frame_times)
+        for name in sorted(self.Times):
+            if self.Times[name]:
+                self.report(name, self.Times[name])
+        self.report("(unattributed)", unattributed)
+        self.Log.info("  %-16s p50 %8d p99 %8d blocks" %
+                      ("allocated", percentile(blocks, 0.5), percentile(blocks, 0.99)))
+        return percentile(frame_times, 0.99)*1000
+
+    def report(self, name, times):
+        self.Log.info("  %-16s p50 %8.2f p99 %8.2f ms" %
+                      (name, percentile(times, 0.5)*1000, percentile(times, 0.99)*1000))
+
+    def run(self, frames):
+        app = self.App
+        worst = {}
+        worst['idle'] = self.measure('idle', frames)
+
+        # Press START through the event queue, like the touch screen would
+        pygame.event.post(pygame.event.Event(MOUSEBUTTONDOWN, pos=app.StartStop.hitRect().center, button=1))
+        pygame.event.post(pygame.event.Event(MOUSEBUTTONUP, pos=app.StartStop.hitRect().center, button=1))
+        app.frame()
+        self.waitForWorker()
+        if not app.TempController.Running:
+            self.Log.error("START press didn't start the controller")
+        worst['running'] = self.measure('running', frames)
+
+        app.handleSettings()
+        worst['settings'] = self.measure('settings', frames)
+        app.handleSettings()
+
+        app.Debug = True
+        worst['debug'] = self.measure('debug', frames)
+        app.Debug = False
+        return worst
+
+
+if __name__ == "__main__":
+    log = logging.getLogger('BenchmarkLogger')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else FRAMES
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else FRAME_BUDGET_MS
+
+    # The App's own logging would end up in the measurements
+    app_log = logging.getLogger('BenchmarkAppLogger')
+    app_log.setLevel(logging.WARNING)
+    app_log.addHandler(logging.StreamHandler())
+
+    data.DataSource = StubDataSource
+    start = time.time()
+    app = gui.App(app_log)
+    while not app.Ready:
+        if app.StartupError is not None:
+            raise app.StartupError
+        if time.time() - start > STARTUP_TIMEOUT:
+            log.error("App didn't start within %ds" % STARTUP_TIMEOUT)
+            sys.exit(1)
+        time.sleep(0.05)
+    log.info("Started in %.2fs" % (time.time() - start))
+
+    benchmark = Benchmark(log, app)
+    benchmark.instrument()
+    worst = benchmark.run(frames)
+
+    over = ["%s %.2fms" % (screen, ms) for screen, ms in sorted(worst.items()) if ms > budget]
+    if over:
+        log.error("p99 frame time over the %.2fms budget: %s" % (budget, ", ".join(over)))
+        sys.exit(1)
+    log.info("All screens within the %.2fms p99 budget" % budget)
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+'''
+Thermistor calibration.
+
+Reference readings are captured by comparing the raw ADC value reported by the
+firmware with a trusted thermometer in the same water. A Steinhart-Hart model
+is fitted to the readings and turned into the lookup table that the firmware
+interpolates to convert its ADC readings.
+
+    python3 calibration.py capture   # add reference readings
+    python3 calibration.py fit       # fit the model and show the residuals
+    python3 calibration.py upload    # send the table to the Arduino
+    python3 calibration.py reset     # go back to the firmware's default
+'''
+
+import json
+import logging
+import math
+import os
+import sys
+
+
+CALIBRATION_FILE = os.path.expanduser("~/.irrigation-calibration.config")
+
+# These have to match the firmware
+ADC_MAX = 1024
+TEMP_TABLE_STEP = 32
+TEMP_TABLE_SIZE = ADC_MAX//TEMP_TABLE_STEP + 1
+
+# Table entries outside of this range are clamped (F)
+MIN_TEMP = -40.0
+MAX_TEMP = 250.0
+
+
+def toKelvin(f):
+    return (f - 32.0)*5.0/9.0 + 273.15
+
+
+def toFahrenheit(k):
+    return (k - 273.15)*9.0/5.0 + 32.0
+
+
+def resistanceRatio(adc):
+    '''
+    The thermistor is the low side of a voltage divider, so the ADC value
+    gives its resistance relative to the fixed resistor. The fixed resistor
+    only scales the ratio, which the model absorbs.
+    '''
+    adc = min(max(adc, 1.0), ADC_MAX - 2.0)
+    return adc/(ADC_MAX - 1.0 - adc)
+
+
+def solve(matrix, vector):
+    '''
+    Gaussian elimination with partial pivoting for the small normal equations
+    '''
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("Calibration readings don't determine the model")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col+1, n):
+            factor = rows[r][col]/rows[col][col]
+            for c in range(col, n+1):
+                rows[r][c] -= factor*rows[col][c]
+
+    result = [0.0]*n
+    for r in reversed(range(n)):
+        result[r] = (rows[r][n] - sum(rows[r][c]*result[c] for c in range(r+1, n)))/rows[r][r]
+    return result
+
+
+class SteinhartHart(object):
+    '''
+    1/T = A + B*ln(R) + C*ln(R)^3
+
+    With only two readings C is left at zero, which is the simpler beta model.
+    '''
+    def __init__(self, a, b, c):
+        self.A = a
+        self.B = b
+        self.C = c
+
+    @classmethod
+    def fit(cls, readings):
+        '''
+        Least squares fit to [(adc, fahrenheit), ...]
+        '''
+        if len(readings) < 2:
+            raise ValueError("At least two calibration readings are needed")
+
+        terms = 3 if len(readings) >= 3 else 2
+        rows = []
+        targets = []
+        for adc, f in readings:
+            ln_r = math.log(resistanceRatio(adc))
+            rows.append([1.0, ln_r, ln_r**3][:terms])
+            targets.append(1.0/toKelvin(f))
+
+        normal = [[sum(row[i]*row[j] for row in rows) for j in range(terms)] for i in range(terms)]
+        rhs = [sum(row[i]*t for row, t in zip(rows, targets)) for i in range(terms)]
+        coefficients = solve(normal, rhs) + [0.0]
+        return cls(*coefficients[:3])
+
+    def fahrenheit(self, adc):
+        ln_r = math.log(resistanceRatio(adc))
+        inverse = self.A + self.B*ln_r + self.C*ln_r**3
+        if inverse <= 0:
+            # The cubic term blows up far outside the calibrated range,
+            # which only happens at the hot (low resistance) end
+            return MAX_TEMP
+        return toFahrenheit(1.0/inverse)
+
+    def table(self):
+        '''
+        Lookup table in tenths of a degree F for the firmware
+        '''
+        table = []
+        for x in range(TEMP_TABLE_SIZE):
+            f = min(max(self.fahrenheit(x*TEMP_TABLE_STEP), MIN_TEMP), MAX_TEMP)
+            table.append(int(round(f*10)))
+        return table
+
+
+class TemperatureTable(object):
+    '''
+    The same O(1) interpolation the firmware uses, for checking a table on
+    the host.
+    '''
+    def __init__(self, table):
+        self.Table = table
+
+    def fahrenheit(self, adc):
+        index = int(adc)//TEMP_TABLE_STEP
+        if index >= len(self.Table) - 1:
+            return self.Table[-1]/10.0
+        fraction = (adc - index*TEMP_TABLE_STEP)/TEMP_TABLE_STEP
+        low = self.Table[index]
+        high = self.Table[index+1]
+        return (low + (high - low)*fraction)/10.0
+
+
+def load():
+    try:
+        with open(CALIBRATION_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'readings': []}
+
+
+def save(calibration):
+    tmp_file = CALIBRATION_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(calibration, f, indent=4)
+    os.replace(tmp_file, CALIBRATION_FILE)
+
+
+def capture(log, arduino, calibration):
+    print("Put the sensor and a reference thermometer in the same water.")
+    print("Enter the reference temperature (F) or nothing to finish.")
+    while True:
+        value = input("Reference F: ").strip()
+        if not value:
+            break
+        adc = arduino.getRawTemperature()
+        if adc is None:
+            log.error("No raw reading from the Arduino")
+            continue
+        calibration['readings'].append([adc, float(value)])
+        log.info("Recorded ADC %.2f at %.1f F" % (adc, float(value)))
+        save(calibration)
+
+
+def fit(log, calibration):
+    readings = calibration['readings']
+    model = SteinhartHart.fit(readings)
+    table = model.table()
+    calibration['coefficients'] = [model.A, model.B, model.C]
+    calibration['table'] = table
+    save(calibration)
+
+    lookup = TemperatureTable(table)
+    for adc, f in readings:
+        log.info("ADC %7.2f: reference %6.1f F, model %6.1f F, table %6.1f F" %
+                 (adc, f, model.fahrenheit(adc), lookup.fahrenheit(adc)))
+    return table
+
+
+if __name__ == "__main__":
+    log = logging.getLogger('CalibrationLogger')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "fit"
+    calibration = load()
+    if command == "fit":
+        fit(log, calibration)
+    else:
+        # control imports pygame, which isn't needed to fit a model
+        import control
+        arduino = control.Arduino(log)
+        if command == "capture":
+            capture(log, arduino, calibration)
+        elif command == "upload":
+            arduino.loadTemperatureTable(fit(log, calibration))
+        elif command == "reset":
+            arduino.clearTemperatureTable()
+        else:
+            print(__doc__)
+            sys.exit(1)
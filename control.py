@@ -1,27 +1,98 @@
+import functools
 import glob
 import json
 import math
 import os
 import pygame
 from pygame.locals import *
-import pytz
-import serial
+import re
 import subprocess
+import threading
 import time
 
 # local imports
+import recording
+import stats
+import tuning
 import widgets
 
 
 PRODUCTION = os.getenv("PRODUCTION")
 SERIAL_PATTERN = "/dev/ttyUSB*"
+# Record the serial traffic to, or replay it from a file (see recording.py)
+SERIAL_RECORD = os.getenv("SERIAL_RECORD")
+SERIAL_REPLAY = os.getenv("SERIAL_REPLAY")
+SERIAL_REPLAY_SPEED = float(os.getenv("SERIAL_REPLAY_SPEED", "1"))
+# C<position>/<travel>H<position>/<travel> in ms of valve motor run time
+VALVE_PATTERN = re.compile(r"C(\d+)/(\d+)H(\d+)/(\d+)")
+# Followed by L<cold><hot>, 1 for a valve on its closed limit switch
+VALVE_LIMIT_PATTERN = re.compile(r"L([01])([01])")
+CALIBRATE_TIMEOUT = 90
+MOVE_TIMEOUT = 16
 
 START_CONTROL_DELAY = 12
 
 UPDATE_DELAY = 5
 IDEAL_TEMP = 72.0
 TEMP_THRESHOLD = 2.0
-TEMP_HOLD = 25/UPDATE_DELAY
+# How long the temperature has to stay in band before output (seconds)
+TEMP_HOLD_TIME = 25
+MAX_PULSES = 3
+# Moves shorter than this don't reliably move the valve (ms)
+MIN_MOVE = 50
+# Where the mixing valves start when the controller starts (percent open)
+START_POSITION = 50
+# A run is only resumed after a restart if it was journaled this recently
+# (seconds). The firmware keeps the valve positions through the reset that
+# opening the port causes, but not through a power cycle. If they don't
+# match the journal (percent) the valves are re-homed and moved back to the
+# journaled positions.
+MAX_RESUME_AGE = 30*60
+RESUME_TOLERANCE = 5
+# A full close takes about the valve's travel time, allow this much longer
+# for the limit switches to be reached (polled every HOME_POLL seconds)
+HOME_ALLOWANCE = 1.25
+HOME_POLL = 0.2
+# Temperature samples (about 1/s) kept for the display and the trend
+HISTORY_SIZE = 10*60
+TREND_SIZE = 30
+MIN_TREND_SAMPLES = 5
+# The firmware cuts the output itself if the temperature gets this far (F)
+# outside the control band, or if it hasn't heard from us for
+# INTERLOCK_WATCHDOG seconds
+INTERLOCK_MARGIN = 2.0
+INTERLOCK_WATCHDOG = 30
+# Serial round trip times kept for the debug overlay
+RTT_SIZE = 50
+# With supply sensors fitted the valves are set straight to the mix that
+# should give the set point. The supplies have to be this far apart (F) for
+# that to be any use.
+MIN_SUPPLY_SPREAD = 5.0
+# The rest of the error is integrated into the target temperature, limited to
+# MAX_TRIM (F) either way
+TRIM_GAIN = 0.5
+MAX_TRIM = 5.0
+
+# Used until tuning.py has been run for the installation
+DEFAULT_TUNING = {
+    'pulse_delay': 400,
+    'update_delay': UPDATE_DELAY,
+    'temp_threshold': TEMP_THRESHOLD,
+    'pulses_per_degree': 1.0,
+    'dead_time': UPDATE_DELAY,
+}
+
+
+def locked(func):
+    '''
+    Hold the Arduino's lock for the whole of a command, so exchanges from
+    the UI and the command worker can't interleave on the serial line
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.Lock:
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 def scale(x, in_min, in_max, out_min, out_max):
@@ -29,73 +100,137 @@ def scale(x, in_min, in_max, out_min, out_max):
 
 
 class FakeSerial(object):
+    Travel = 4000
+    # Valve positions kept through a reset
+    Retained = (0, 0)
+    HotSupply = 120.0
+    ColdSupply = 50.0
+    Ambient = 70.0
+
     def __init__(self, log, *args, **kwargs):
         self.Log = log
         self.Commands = {
             'V': 'or',
+            'A': '164.0',
             'I': 'I',
             'c': 'c',
             'C': 'C',
             'h': 'h',
             'H': 'H',
+            'K': 'K',
+            'L': 'L',
+            'l': 'l',
+            'M': 'M',
             'o': 'o',
             'O': 'O',
             'P': 'P',
             'p': 'p',
             'r': 'r',
             'R': 'R',
-            'T': '60.0'
+            'S': 'S',
+            'T': '60.0',
+            'W': 'W',
+            'X': 'X',
+            'x': 'x'
         }
+        # Mixing valve positions are in ms of motor run time. Like the
+        # firmware, they are kept through a reset.
         self.Valves = {
-            'c': '',
-            'h': '',
+            'c': FakeSerial.Retained[0],
+            'h': FakeSerial.Retained[1],
             'o': 'o',
             'r': 'r'
         }
+        self.PulseDelay = 400
         self.Temp = 60.0
         self.Last = ''
+        # (low, high) in F when the interlock is on
+        self.Interlock = None
+        # Event lines waiting to be read
+        self.Pending = []
 
     def close(self):
-        self.Valves = {
-            'c': '',
-            'h': '',
-            'o': 'o',
-            'r': 'r'
-        }
-        return
+        # The next FakeSerial is the firmware after a reset
+        FakeSerial.Retained = (self.Valves['c'], self.Valves['h'])
+
+    def _move(self, valve, ms):
+        self.Valves[valve] = min(max(self.Valves[valve] + ms, 0), self.Travel)
+
+    def _temperature(self):
+        # Flow is taken to be in proportion to how far each valve is open
+        flow = self.Valves['c'] + self.Valves['h']
+        if flow == 0:
+            temp = self.Ambient
+        else:
+            temp = (self.Valves['c']*self.ColdSupply + self.Valves['h']*self.HotSupply)/flow
+        if self.Interlock is not None and self.Valves['o'] == 'O':
+            if not self.Interlock[0] <= temp <= self.Interlock[1]:
+                self.Valves['o'] = 'o'
+                self.Valves['r'] = 'R'
+                self.Pending.append("!T%d" % (temp*10))
+        return temp
 
     def write(self, value):
         self.Last = value.decode()
+        code = self.Last[:1]
         if self.Last.lower() == 'o':
             self.Valves['o'] = self.Last
         elif self.Last.lower() == 'r':
             self.Valves['r'] = self.Last
-        elif self.Last == 'c' and len(self.Valves['c']) > 0:
-            self.Valves['c'] = self.Valves['c'][:-1]
-        elif self.Last == 'C' and len(self.Valves['c']) < 10:
-            self.Valves['c'] = self.Valves['c'] + "C"
-        elif self.Last == 'h' and len(self.Valves['h']) > 0:
-            self.Valves['h'] = self.Valves['h'][:-1]
-        elif self.Last == 'H' and len(self.Valves['h']) < 10:
-            self.Valves['h'] = self.Valves['h'] + "H"
+        elif code in ('c', 'h'):
+            self._move(code, -self.PulseDelay)
+        elif code in ('C', 'H'):
+            self._move(code.lower(), self.PulseDelay)
+        elif code == 'M':
+            self._move(self.Last[1], int(self.Last[2:]))
+        elif code == 'S':
+            self.PulseDelay = int(self.Last[1:])
+        elif code == 'X':
+            low, high, watchdog = [int(v) for v in self.Last[1:].split(',')]
+            self.Interlock = (low/10.0, high/10.0)
+        elif code == 'x':
+            self.Interlock = None
+        elif code == 'T':
+            self.Temp = self._temperature()
 
     def readline(self):
+        if self.Pending:
+            return (self.Pending.pop(0) + "\n").encode()
         if self.Last == 'T':
-            temp = 75.0 - len(self.Valves['c'])*2 + len(self.Valves['h'])*2
-            send = str(temp)
+            send = "%.2f,%.2f,%.2f" % (self.Temp, self.HotSupply, self.ColdSupply)
         elif self.Last == 'V':
-            send = "".join(self.Valves.values())
+            send = "C%d/%dH%d/%d%s%sL%d%d" % (self.Valves['c'], self.Travel,
+                                              self.Valves['h'], self.Travel,
+                                              self.Valves['o'], self.Valves['r'],
+                                              self.Valves['c'] == 0, self.Valves['h'] == 0)
         else:
-            send = self.Commands.get(self.Last, 'E')
+            send = self.Commands.get(self.Last[:1], 'E')
         return (send + "\n").encode()
 
 
 class Arduino(object):
-    def __init__(self, log):
+    def __init__(self, log, connect=True):
         self.Log = log
         self.Stream = None
-        self._newSerial()
+        self.PulseDelay = None
         self.Running = False
+        self.Lock = threading.RLock()
+        self.Recorder = None
+        self.Replay = None
+        # Seconds from sending a command to its response
+        self.RTT = stats.RollingWindow(RTT_SIZE)
+        # When a command last failed and the serial port was last reset
+        self.LastFailure = 0
+        self.LastReset = 0
+        # The last valve states that could be read
+        self.ValveStates = None
+        # Called with the event line when the firmware reports one
+        self.Listeners = []
+        if connect:
+            self.connect()
+
+    def connect(self):
+        self._newSerial()
 
     def _newSerial(self):
         '''
@@ -106,25 +241,44 @@ class Arduino(object):
         except:
             pass
 
-        if PRODUCTION:
+        if SERIAL_REPLAY:
+            if self.Replay is None:
+                self.Replay = recording.ReplaySerial(self.Log, SERIAL_REPLAY, SERIAL_REPLAY_SPEED)
+            self.Stream = self.Replay
+        elif PRODUCTION:
             serial_devices = glob.glob(SERIAL_PATTERN)
             if len(serial_devices) < 1:
                 self.Log.error("No Serial devices detected. Restarting ...")
                 subprocess.call("sudo reboot", shell=True)
 
+            # Only needed on the real hardware
+            import serial
             self.SerialDevice = sorted(serial_devices)[-1]
             self.Stream = serial.Serial(self.SerialDevice, 57600, timeout=1)
         else:
             self.Stream = FakeSerial(self.Log)
 
+        if SERIAL_RECORD and not SERIAL_REPLAY:
+            if self.Recorder is None:
+                self.Recorder = recording.Recorder(SERIAL_RECORD)
+            self.Stream = recording.RecordingSerial(self.Stream, self.Recorder)
+
         # Throw away some garbage at the begining
         self.Stream.readline()
         if self._sendData('I') == 'I':
+            # The firmware forgets its settings when it resets
+            if self.PulseDelay is not None:
+                self.setPulseDelay(self.PulseDelay)
             return
         # still not reset
-        self.Log.error("Failed to reset Serial!!!")
+        self._failed("Failed to reset Serial!!!")
+
+    def _failed(self, message):
+        self.LastFailure = time.time()
+        self.Log.error(message)
 
     def resetSerial(self):
+        self.LastReset = time.time()
         try:
             self.Stream.close()
         except:
@@ -133,11 +287,26 @@ class Arduino(object):
         time.sleep(2)
         self._newSerial()
 
+    def addListener(self, listener):
+        self.Listeners.append(listener)
+
+    def _handleEvent(self, event):
+        self.Log.error("Arduino event: %s" % (event))
+        for listener in self.Listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                self.Log.error("Arduino event listener failed: %s" % (e), exc_info=1)
+
     def _readResponse(self):
         try:
             response = self.Stream.readline().decode('utf-8').strip()
-            while len(response) > 0 and response.startswith('D'):
-                self.Log.debug(response)
+            # Debug output and events can turn up ahead of a response
+            while len(response) > 0 and response[0] in ('D', '!'):
+                if response.startswith('!'):
+                    self._handleEvent(response)
+                else:
+                    self.Log.debug(response)
                 response = self.Stream.readline().decode('utf-8').strip()
         except Exception as e:
             self.Log.error("Serial exception: %s" % (e), exc_info=1)
@@ -146,23 +315,52 @@ class Arduino(object):
         self.Log.debug("SERIAL - Response: '%s'" % (response))
         return response
 
+    @locked
     def _sendData(self, value):
         v = bytes(value, 'utf-8')
         self.Log.debug("SERIAL - Sending: %s" % (v))
+        start = time.time()
         self.Stream.write(v)
-        return self._readResponse()
+        response = self._readResponse()
+        now = time.time()
+        self.RTT.append(now, now - start)
+        return response
 
     def handleDebugMessages(self):
         self._readResponse()
 
+    @locked
     def getValveStates(self):
+        '''
+        The last good states are returned if the reply can't be read, and
+        None if there haven't been any
+        '''
         valves = self._sendData("V")
+        match = VALVE_PATTERN.search(valves)
+        if not match:
+            self.Log.error("Unexpected valve state: '%s'" % valves)
+            return self.ValveStates
+        cold, cold_travel, hot, hot_travel = [int(v) for v in match.groups()]
+        if cold_travel == 0 or hot_travel == 0:
+            self.Log.error("Unexpected valve travel: '%s'" % valves)
+            return self.ValveStates
+
         state = {
-            'cold': valves.count('C')*10,
-            'hot': valves.count('H')*10,
+            'cold': 100.0*cold/cold_travel,
+            'hot': 100.0*hot/hot_travel,
+            'cold_travel': cold_travel,
+            'hot_travel': hot_travel,
             'output': 'CLOSED' if 'o' in valves else 'OPEN',
-            'recycle': 'CLOSED' if 'r' in valves else 'OPEN'
+            'recycle': 'CLOSED' if 'r' in valves else 'OPEN',
+            # None with firmware that doesn't report the limit switches
+            'cold_closed': None,
+            'hot_closed': None,
         }
+        limits = VALVE_LIMIT_PATTERN.search(valves, match.end())
+        if limits:
+            state['cold_closed'] = limits.group(1) == '1'
+            state['hot_closed'] = limits.group(2) == '1'
+        self.ValveStates = state
         return state
 
     def _convertFloat(self, value):
@@ -171,25 +369,146 @@ class Arduino(object):
         except Exception:
             return None
 
-    def getTemperature(self):
-        result = self._convertFloat(self._sendData("T"))
+    def _parseTemperatures(self, response):
+        fields = response.split(",")
+        mixed = self._convertFloat(fields[0])
+        if mixed is None:
+            return None
+        # Older firmware only sends the mixed temperature
+        supplies = [self._convertFloat(field) for field in fields[1:3]]
+        supplies += [None]*(2 - len(supplies))
+        return (mixed, supplies[0], supplies[1])
+
+    @locked
+    def getTemperatures(self):
+        '''
+        (mixed, hot supply, cold supply) in F. Supply sensors that aren't
+        fitted are None. None if the temperatures couldn't be read.
+        '''
+        result = self._parseTemperatures(self._sendData("T"))
         if result is None:
-            result = self._convertFloat(self._readResponse())
+            result = self._parseTemperatures(self._readResponse())
 
         if result is None:
-            self.Log.error(
-                "float conversion failed for Arduino.getTemperature()")
-            return 0.0
+            self._failed("float conversion failed for Arduino.getTemperatures()")
 
         return result
 
+    def getTemperature(self):
+        result = self.getTemperatures()
+        return result[0] if result is not None else None
+
+    @locked
+    def getRawTemperature(self):
+        '''
+        Averaged ADC reading of the thermistor, for calibration
+        '''
+        result = self._convertFloat(self._sendData("A"))
+        if result is None:
+            result = self._convertFloat(self._readResponse())
+        return result
+
+    @locked
+    def loadTemperatureTable(self, table):
+        '''
+        Upload a thermistor lookup table (tenths of a degree F, see
+        calibration.py). The firmware saves it once the last entry arrives.
+        '''
+        self.Log.info("Uploading %d entry temperature table" % len(table))
+        for index, value in enumerate(table):
+            if not self._sendSetting('L', index, value):
+                return False
+        return True
+
+    def clearTemperatureTable(self):
+        return self._controlValve('l')
+
+    @locked
     def _controlValve(self, value):
         if self._sendData(str(value)) == str(value):
             return True
         elif self._readResponse() == str(value):
             return True
         else:
-            self.Log.error("Arduino command %s Failed." % value)
+            self._failed("Arduino command %s Failed." % value)
+        return False
+
+    @locked
+    def _sendSetting(self, code, *values):
+        '''
+        Settings are sent as a command character followed by comma separated
+        integer arguments and a newline. The firmware echos the command
+        character.
+        '''
+        args = ",".join(["%d" % v for v in values])
+        if self._sendData("%s%s\n" % (code, args)) == code:
+            return True
+        elif self._readResponse() == code:
+            return True
+        else:
+            self._failed("Arduino setting %s=%s Failed." % (code, args))
+        return False
+
+    def setPulseDelay(self, ms):
+        '''
+        Set how long (ms) the mixing valve motors run for each pulse
+        '''
+        self.PulseDelay = int(ms)
+        return self._sendSetting('S', self.PulseDelay)
+
+    def setInterlock(self, low, high, watchdog):
+        '''
+        Have the firmware switch to recirculation as soon as the temperature
+        leaves low..high (F) with the output open, and shut all the water off
+        if it hears nothing from us for watchdog seconds (0 for never). Any
+        command counts, so the regular status updates keep it fed.
+        '''
+        return self._sendSetting('X', int(round(low*10)), int(round(high*10)), int(watchdog))
+
+    def clearInterlock(self):
+        return self._controlValve('x')
+
+    def _waitFor(self, response, code, timeout):
+        '''
+        Keep reading until the firmware acknowledges a long running command
+        '''
+        start = time.time()
+        while response != code and time.time() - start < timeout:
+            response = self._readResponse()
+        return response == code
+
+    @locked
+    def _moveValve(self, valve, ms):
+        # Moves are from the position 'V' reports, which is live while a
+        # valve moves, so a move replaces any still in progress. Moves that
+        # reach the end of travel run on to the limit switch.
+        if self._waitFor(self._sendData("M%s%d\n" % (valve, ms)), 'M', MOVE_TIMEOUT):
+            return True
+        self._failed("Arduino move %s %dms Failed." % (valve, ms))
+        return False
+
+    def moveCold(self, ms):
+        '''
+        Run the cold valve motor for ms, negative values close the valve
+        '''
+        return self._moveValve('c', ms)
+
+    def moveHot(self, ms):
+        '''
+        Run the hot valve motor for ms, negative values close the valve
+        '''
+        return self._moveValve('h', ms)
+
+    @locked
+    def calibrateValves(self):
+        '''
+        Measure the travel time of both mixing valves between their limit
+        switches. This takes several full valve movements.
+        '''
+        self.Log.info("Calibrating mixing valves")
+        if self._waitFor(self._sendData('K'), 'K', CALIBRATE_TIMEOUT):
+            return True
+        self._failed("Mixing valve calibration Failed.")
         return False
 
     def pulseOpenCold(self):
@@ -224,12 +543,15 @@ class Arduino(object):
 
 
 class MixingValveControl(object):
-    def __init__(self, pos, size, log, arduino):
+    def __init__(self, pos, size, log, arduino, controller):
         self.Position = pos
         self.Size = size
         self.ValveSize = (121, 64)
         self.Log = log
         self.Arduino = arduino
+        # Positions are read from the TempControl's last status update, so
+        # rendering never waits on the serial line
+        self.Controller = controller
         self.Font = pygame.font.SysFont("avenir", 48)
         self.Status = widgets.MixingValveStatus((self.Size[0]/2, self.Size[1]/2), self.ValveSize, self.getPercent, center=True) 
         self.Left = widgets.LeftButton((self.Size[0]/2 - self.ValveSize[0],self.Size[1]/2), self.handleLeft, center=True)
@@ -244,15 +566,10 @@ class MixingValveControl(object):
     def handleRight(self):
         return
 
-    def handleEvent(self, event):
-        if hasattr(event, 'pos'):
-            event_pos = (event.pos[0] - self.Position[0], event.pos[1] - self.Position[1])
-            if event.type == MOUSEBUTTONDOWN:
-                if self.Left.handleClick(event_pos):
-                    return True
-                elif self.Right.handleClick(event_pos):
-                    return True
-        return False
+    def targets(self):
+        # (rect, handler) in screen coordinates
+        return [(self.Left.Rect.move(self.Position), self.handleLeft),
+                (self.Right.Rect.move(self.Position), self.handleRight)]
     
     def render(self, surface):
         base_surface = pygame.surface.Surface(self.Size)
@@ -285,29 +602,25 @@ class MixingValveControl(object):
 class ColdControl(MixingValveControl):
     ValveName = ' COLD '
     def getPercent(self):
-        return self.Arduino.getValveStates()['cold']
+        return self.Controller.ColdValvePercent
     
     def handleLeft(self):
         self.Arduino.pulseCloseCold()
-        self.Status.Percent = self.getPercent()
     
     def handleRight(self):
         self.Arduino.pulseOpenCold()
-        self.Status.Percent = self.getPercent()
 
 
 class HotControl(MixingValveControl):
     ValveName = ' HOT '
     def getPercent(self):
-        return self.Arduino.getValveStates()['hot']
+        return self.Controller.HotValvePercent
 
     def handleLeft(self):
         self.Arduino.pulseCloseHot()
-        self.Status.Percent = self.getPercent()
     
     def handleRight(self):
         self.Arduino.pulseOpenHot()
-        self.Status.Percent = self.getPercent()
 
 
 class OnOffValveControl(object):
@@ -329,13 +642,9 @@ class OnOffValveControl(object):
     def handleClose(self):
         return
 
-    def handleEvent(self, event):
-        if hasattr(event, 'pos'):
-            event_pos = (event.pos[0] - self.Position[0], event.pos[1] - self.Position[1])
-            if event.type == MOUSEBUTTONDOWN:
-                if self.Button.handleClick(event_pos):
-                    return True
-        return False
+    def targets(self):
+        # (rect, handler) in screen coordinates
+        return [(self.Button.hitRect().move(self.Position), self.Button.toggle)]
     
     def render(self, surface):
         base_surface = pygame.surface.Surface(self.Size)
@@ -397,22 +706,170 @@ class TempControl(object):
 
         # Hot and Cold Valves
         self.HotValvePercent = 0
+        self.HotTravel = 0
         self.HotValve = widgets.MixingValveStatus((21, 335), self.ValveSize, self.getHotPercent)
 
         self.ColdValvePercent = 0
+        self.ColdTravel = 0
         self.ColdValve = widgets.MixingValveStatus((169, 335), self.ValveSize, self.getColdPercent)
 
         # Temperature
         self.Temperature = 75.0
+        # Whether the last reading worked, the control loop waits for one
+        # that did rather than act on a made up value
+        self.TemperatureValid = False
+        self.HotSupply = None
+        self.ColdSupply = None
+        self.Trim = 0.0
+        # Whether the valves were already at the mix on the last control pass
+        self.Mixed = False
         self.TemperaturePosition = (155, 245)
         self.TemperatureRadius = 40
+        self.SetPoint = IDEAL_TEMP
+        self.History = stats.RollingWindow(HISTORY_SIZE)
+        self.Trend = stats.RollingWindow(TREND_SIZE)
+        self.Sparkline = widgets.Sparkline((420, 89), (360, 60), self.History,
+                                           (IDEAL_TEMP - 10, IDEAL_TEMP + 10))
+        self.Chart = widgets.TrendChart((420, 165), (360, 240),
+                                        (IDEAL_TEMP - 10, IDEAL_TEMP + 10))
+
+        # Per installation controller tuning
+        self.Tuning = tuning.load(self.Log, DEFAULT_TUNING)
+        self.UpdateDelay = self.Tuning['update_delay']
+        self.TempThreshold = self.Tuning['temp_threshold']
+        self.TempHold = max(int(TEMP_HOLD_TIME/self.UpdateDelay), 1)
+        self.MsPerDegree = self.Tuning['pulses_per_degree']*self.Tuning['pulse_delay']
+        self.MaxMove = MAX_PULSES*self.Tuning['pulse_delay']
+        self.DeadTime = self.Tuning['dead_time']
 
         self.Font = pygame.font.SysFont("avenir", 30)
         self.LastUpdate = 0
         self.LastControl = 0
         self.Running = False
+        self.WarmingUp = False
+        self.AtTemp = 0
+        # Called with getState() after every status update
+        self.Listeners = []
+        # Set from the Arduino's event listener when the firmware cuts the
+        # output, handled on the next control pass
+        self.Interlocked = None
+        self.Arduino.addListener(self.handleArduinoEvent)
+
+    def initialise(self, saved=None):
+        '''
+        Bring the hardware to a known state. This talks to the Arduino so it
+        is kept out of the constructor.
+
+        saved is the state journaled before a restart. If the run it describes
+        is recent enough it is resumed instead of closing all the valves.
+        Returns True if the run was resumed.
+        '''
+        with self.Arduino.Lock:
+            self.Arduino.setPulseDelay(self.Tuning['pulse_delay'])
+            self.updateStatus()
+            if saved is None or not self.canResume(saved):
+                self.handleStop()
+                return False
+
+        # Re-homing takes a while, so it doesn't hold the lock throughout
+        if not self.valvesMatch(saved):
+            self.restoreValves(saved)
+        with self.Arduino.Lock:
+            self.resume(saved)
+        return True
+
+    def canResume(self, saved):
+        if not saved.get('running'):
+            return False
+        if time.time() - saved['saved'] > MAX_RESUME_AGE:
+            self.Log.info("Journaled run is too old to resume")
+            return False
+        return True
+
+    def valvesMatch(self, saved):
+        # A firmware reset forgets the valve positions, which shows up here
+        if (abs(saved['hot'] - self.HotValvePercent) > RESUME_TOLERANCE or
+                abs(saved['cold'] - self.ColdValvePercent) > RESUME_TOLERANCE):
+            self.Log.info("Valve positions don't match the journal (hot %.1f/%.1f, cold %.1f/%.1f)" %
+                          (self.HotValvePercent, saved['hot'], self.ColdValvePercent, saved['cold']))
+            return False
+        return True
+
+    def restoreValves(self, saved):
+        '''
+        Run the valves closed to their limit switches so their positions are
+        known again, then move them back to where the journal has them
+        '''
+        self.Log.info("Re-homing the mixing valves")
+        self.Arduino.moveHot(-self.HotTravel)
+        self.Arduino.moveCold(-self.ColdTravel)
+        # A move replaces one in progress, so the homing has to finish first
+        deadline = time.time() + max(self.HotTravel, self.ColdTravel)*HOME_ALLOWANCE/1000.0
+        while time.time() < deadline:
+            states = self.Arduino.getValveStates()
+            if states is not None and states['hot_closed'] and states['cold_closed']:
+                break
+            time.sleep(HOME_POLL)
+        self.Arduino.moveHot(saved['hot']*self.HotTravel/100)
+        self.Arduino.moveCold(saved['cold']*self.ColdTravel/100)
+        self.LastUpdate = 0
         self.updateStatus()
-        self.handleStop()
+
+    def resume(self, saved):
+        self.Log.info("Resuming Temp Controller from the journal")
+        self.SetPoint = saved['setpoint']
+        self.Interlocked = None
+        self.armInterlock()
+        self.Running = True
+        self.AtTemp = 0
+        self.LastControl = time.time()
+        if saved['warming_up'] or not self.OutputOpen:
+            self.startWarmUp()
+        else:
+            self.WarmingUp = False
+            self.Recirculating = self.RecirculationValveOpen
+
+    def addListener(self, listener):
+        self.Listeners.append(listener)
+
+    def seed(self, history):
+        '''
+        Fill the history and chart from archived samples ({column: values}),
+        so they aren't empty after a restart
+        '''
+        samples = list(zip(history['time'], history['temperature'], history['hot'], history['cold']))
+        for t, temperature, hot, cold in samples:
+            self.History.append(t, temperature)
+        # Only what fits on the chart. The archive doesn't keep the set point,
+        # so the current one is shown.
+        for t, temperature, hot, cold in samples[-self.Chart.Size[0]//self.Chart.ColumnWidth:]:
+            self.Chart.push(temperature, hot, cold, self.SetPoint)
+
+    def armInterlock(self):
+        band = self.TempThreshold + INTERLOCK_MARGIN
+        self.Arduino.setInterlock(self.SetPoint - band, self.SetPoint + band, INTERLOCK_WATCHDOG)
+
+    def handleArduinoEvent(self, event):
+        # !T<tenths of a degree F>: out of band, switched to recirculation
+        # !W: the watchdog shut the water off
+        if event[1:2] in ('T', 'W'):
+            self.Interlocked = event
+
+    def getState(self):
+        return {
+            'time': self.LastUpdate,
+            'temperature': self.Temperature,
+            'hot': self.HotValvePercent,
+            'cold': self.ColdValvePercent,
+            'output': self.OutputOpen,
+            'recycle': self.RecirculationValveOpen,
+            'recirculating': self.Recirculating,
+            'running': self.Running,
+            'warming_up': self.WarmingUp,
+            'setpoint': self.SetPoint,
+            'hot_supply': self.HotSupply,
+            'cold_supply': self.ColdSupply,
+        }
 
     def getHotPercent(self):
         return self.HotValvePercent
@@ -430,95 +887,203 @@ class TempControl(object):
         self.Arduino.stopRecyclePump()
         self.Arduino.closeRecycle()
 
-    def handleStart(self):
-        self.Log.info("Starting Temp Controller")
-        # self.startRecycle()
-        for x in range(5):
-            self.Arduino.pulseOpenCold()
-            self.Arduino.pulseOpenHot()
-        
+    def startWarmUp(self):
+        '''
+        Send the mixed water back through the recirculation loop until it
+        holds at temperature. The output stays closed so that no out of range
+        water reaches the plants. Recirculation is opened before the output
+        closes so the flow is never dead-headed.
+        '''
+        self.Log.info("Warming up")
+        self.WarmingUp = True
+        self.AtTemp = 0
+        self.startRecycle()
+        self.Arduino.closeOutput()
+
+    def finishWarmUp(self):
+        '''
+        Switch the flow from recirculation to the output. The output is opened
+        before the recycle valve closes so the flow is never dead-headed.
+        '''
+        self.Log.info("Water is at temp. Switching to output")
+        self.WarmingUp = False
         self.Arduino.openOutput()
+        self.stopRecycle()
 
-        self.Running = True
-        self.AtTemp = 0
-        self.LastControl = time.time()
-        self.updateStatus()
+    def handleStart(self):
+        self.Log.info("Starting Temp Controller")
+        with self.Arduino.Lock:
+            self.Arduino.moveCold((START_POSITION - self.ColdValvePercent)*self.ColdTravel/100)
+            self.Arduino.moveHot((START_POSITION - self.HotValvePercent)*self.HotTravel/100)
+
+            self.Trim = 0.0
+            self.Mixed = False
+            # Anything the firmware reported while stopped is stale
+            self.Interlocked = None
+            self.startWarmUp()
+            self.armInterlock()
+
+            self.Running = True
+            self.LastControl = time.time()
+            # Publish the new valve states now rather than after the next
+            # regular update
+            self.LastUpdate = 0
+            self.updateStatus()
 
     def handleStop(self):
-        self.Running = False
-        self.AtTemp = 0
-        self.Log.info("Stopping Temp Controller")
-        self.Arduino.closeOutput()
-        # self.stopRecycle()
-        for x in range(int(self.HotValvePercent/10+1)):
-            self.Arduino.pulseCloseHot()
-        for x in range(int(self.ColdValvePercent/10)+1):
-            self.Arduino.pulseCloseCold()
-        
-    def handleEvent(self, event):
-        # if event.type == MOUSEBUTTONDOWN:
-        #     self.ReturnButton.handleClick(event.pos)
-        #     return True
-        return False
+        with self.Arduino.Lock:
+            self.Running = False
+            self.WarmingUp = False
+            self.AtTemp = 0
+            self.Interlocked = None
+            self.Log.info("Stopping Temp Controller")
+            self.Arduino.clearInterlock()
+            self.Arduino.closeOutput()
+            self.stopRecycle()
+            # Moving past closed runs the valves to their limit switches
+            self.Arduino.moveHot(-self.HotTravel)
+            self.Arduino.moveCold(-self.ColdTravel)
+
+    def updateStatus(self, control=True):
+        '''
+        Read the hardware state and, if control is set, run the control
+        logic. The settings screen only wants the state, so its manual
+        valve moves aren't fought over.
+        '''
+        # The command worker may be in the middle of a move. Rather than
+        # hold up the frame, the update waits for the next one.
+        if not self.Arduino.Lock.acquire(blocking=False):
+            return
+        try:
+            self._updateStatus(control)
+        finally:
+            self.Arduino.Lock.release()
 
-    def updateStatus(self):
+    def _updateStatus(self, control=True):
         now = time.time()
         if now - self.LastUpdate > 1:
             states = self.Arduino.getValveStates()
             self.Log.debug("Valve States: %s" % states)
-            self.HotValvePercent = states['hot']
-            self.ColdValvePercent = states['cold']
-            self.RecirculationValveOpen = (states['recycle'] == "OPEN")
-            self.OutputOpen = (states['output'] == "OPEN")
-            self.Temperature = self.Arduino.getTemperature()
+            if states is not None:
+                self.HotValvePercent = states['hot']
+                self.ColdValvePercent = states['cold']
+                self.HotTravel = states['hot_travel']
+                self.ColdTravel = states['cold_travel']
+                self.RecirculationValveOpen = (states['recycle'] == "OPEN")
+                self.OutputOpen = (states['output'] == "OPEN")
+            temperatures = self.Arduino.getTemperatures()
+            self.TemperatureValid = temperatures is not None
+            if self.TemperatureValid:
+                self.Temperature, self.HotSupply, self.ColdSupply = temperatures
+                self.History.append(now, self.Temperature)
+                self.Trend.append(now, self.Temperature)
+                self.Chart.push(self.Temperature, self.HotValvePercent, self.ColdValvePercent, self.SetPoint)
             self.LastUpdate = now
+
+            # Listeners record the state as a sample, so only real readings
+            # are passed on
+            if self.TemperatureValid:
+                state = self.getState()
+                for listener in self.Listeners:
+                    try:
+                        listener(state)
+                    except Exception as e:
+                        self.Log.error("State listener failed: %s" % (e), exc_info=1)
+
+        if not control:
+            return
         
+        # The firmware has already closed the output. Go back to warming up
+        # so the output is only reopened once the temperature holds.
+        if self.Running and self.Interlocked is not None:
+            self.Log.error("Arduino interlock tripped (%s). Warming up again" % self.Interlocked)
+            self.Interlocked = None
+            self.startWarmUp()
+
         # Control logic
-        if self.Running and now - self.LastControl > UPDATE_DELAY:
+        if self.Running and self.TemperatureValid and now - self.LastControl > self.UpdateDelay:
             # Make sure water that is out of temp doesn't go to plants
-            # if self.Temperature < (IDEAL_TEMP - TEMP_THRESHOLD):
-            #     if self.OutputOpen:
-            #         self.Log.error("Temp got too cold. cutting water")
-            #         self.startRecycle()
-            #         self.Arduino.closeOutput()
-            #         self.AtTemp = 0
-            # elif self.Temperature > (IDEAL_TEMP + TEMP_THRESHOLD):
-            #     if self.OutputOpen:
-            #         self.Log.error("Temp got too hot. cutting water")
-            #         self.startRecycle()
-            #         self.Arduino.closeOutput()
-            #         self.AtTemp = 0
-            # else:
-            #     # Open the output once it is ready
-            #     self.Log.info("Water is at temp")
-            #     if not self.OutputOpen:
-            #         self.AtTemp += 1
-            #         # if self.AtTemp >= TEMP_HOLD:
-            #         self.stopRecycle()
-            #         self.Arduino.openOutput()
+            in_band = abs(self.Temperature - self.SetPoint) <= self.TempThreshold
+            if self.WarmingUp:
+                if in_band:
+                    self.AtTemp += 1
+                    self.Log.debug("At temp for %d/%d samples" % (self.AtTemp, self.TempHold))
+                    if self.AtTemp >= self.TempHold:
+                        self.finishWarmUp()
+                else:
+                    self.AtTemp = 0
+            elif not in_band:
+                self.Log.error("Temp out of range (%.1f F). cutting water" % self.Temperature)
+                self.startWarmUp()
 
             # Adjust water mixing to maintain even temp
             # TODO: This might lead to huge swings since it will tend to
             #       max out hot and cold first (but we want full pressure/flow)
-            if self.Temperature < IDEAL_TEMP:
+            # Correct in proportion to the error, but limit the size of a
+            # single move since the result lags behind. The error is taken
+            # from where the trend says the temperature will be once the dead
+            # time has passed, so moves already on their way aren't repeated.
+            predicted = self.Temperature
+            if len(self.Trend) >= MIN_TREND_SAMPLES:
+                predicted = self.Trend.predict(now + self.DeadTime)
+            error = self.SetPoint - predicted
+            ratio = self.mixRatio(error)
+            ms = min(abs(error)*self.MsPerDegree, self.MaxMove)
+            if ratio is not None:
+                self.moveToRatio(ratio)
+            elif ms < MIN_MOVE:
+                pass
+            elif error > 0:
                 if self.HotValvePercent < 100:
-                    self.Arduino.pulseOpenHot()
+                    self.Arduino.moveHot(ms)
                 elif self.ColdValvePercent > 0:
-                    self.Arduino.pulseCloseCold()
+                    self.Arduino.moveCold(-ms)
                 else:
                     # Error state
                     self.Log.error("Hot is maxed out")
-            elif self.Temperature > IDEAL_TEMP:
+            else:
                 if self.ColdValvePercent < 100:
-                    self.Arduino.pulseOpenCold()
+                    self.Arduino.moveCold(ms)
                 elif self.HotValvePercent > 0:
-                    self.Arduino.pulseCloseHot()
+                    self.Arduino.moveHot(-ms)
                 else:
                     # ERROR State
                     self.Log.error("COLD is maxed out")
 
             self.LastControl = now
 
+    def mixRatio(self, error):
+        '''
+        Fraction of the flow that should be hot to hit the set point, worked
+        out from the supply temperatures. None if they aren't both known.
+        '''
+        if self.HotSupply is None or self.ColdSupply is None:
+            return None
+        spread = self.HotSupply - self.ColdSupply
+        if spread < MIN_SUPPLY_SPREAD:
+            return None
+        # Flow isn't quite in proportion to the valve positions, so what is
+        # left of the error once the valves are at the mix is integrated
+        # into the target
+        if self.Mixed:
+            self.Trim = min(max(self.Trim + error*TRIM_GAIN, -MAX_TRIM), MAX_TRIM)
+        return min(max((self.SetPoint + self.Trim - self.ColdSupply)/spread, 0.0), 1.0)
+
+    def moveToRatio(self, ratio):
+        # The larger share is fully open for the most flow
+        if ratio >= 0.5:
+            hot, cold = 100.0, 100.0*(1 - ratio)/ratio
+        else:
+            hot, cold = 100.0*ratio/(1 - ratio), 100.0
+        hot_ms = (hot - self.HotValvePercent)*self.HotTravel/100
+        cold_ms = (cold - self.ColdValvePercent)*self.ColdTravel/100
+        self.Log.debug("Mixing %.0f%% hot: hot %.0f%%, cold %.0f%%" % (ratio*100, hot, cold))
+        self.Mixed = abs(hot_ms) < MIN_MOVE and abs(cold_ms) < MIN_MOVE
+        if abs(hot_ms) >= MIN_MOVE:
+            self.Arduino.moveHot(hot_ms)
+        if abs(cold_ms) >= MIN_MOVE:
+            self.Arduino.moveCold(cold_ms)
+
     def render(self):
         now = int(time.time())
         self.updateStatus()
@@ -560,24 +1125,29 @@ class TempControl(object):
         txt_surface = self.Font.render("%d F"%self.Temperature, 1, widgets.BLACK)
         surface.blit(txt_surface, (self.TemperaturePosition[0]-self.TemperatureRadius/1.5, self.TemperaturePosition[1]-self.TemperatureRadius/2))
 
+        # Recent temperature history
+        self.Sparkline.render(surface)
+        self.Chart.render(surface)
+
         self.Screen.blit(surface, (0,0))
 
 
 class Settings(object):
-    def __init__(self, log, screen, arduino, return_handler):
+    def __init__(self, log, screen, arduino, controller, return_handler):
         self.Log = log
         self.Screen = screen
         self.Size = screen.get_size()
         self.Arduino = arduino
+        self.Controller = controller
         self.ReturnHandler = return_handler
 
         # Return button + 4 controls
         widget_size = (self.Size[0]/2, self.Size[1]/2)
         self.ReturnButton = widgets.ReturnButton((self.Size[0]-55, 5), self.handleReturn)
         # Cold: Top Left
-        self.ColdControl = ColdControl((0,0), widget_size, self.Log, self.Arduino)
+        self.ColdControl = ColdControl((0,0), widget_size, self.Log, self.Arduino, self.Controller)
         # Hot: Bottom Left
-        self.HotControl = HotControl((0, self.Size[1]/2+1), widget_size, self.Log, self.Arduino)
+        self.HotControl = HotControl((0, self.Size[1]/2+1), widget_size, self.Log, self.Arduino, self.Controller)
         # Recirculation: Top Right
         self.RecirculationControl = RecirculationControl((self.Size[0]/2+1,0), widget_size, self.Log, self.Arduino)
         # Output: Bottom Right
@@ -586,21 +1156,21 @@ class Settings(object):
     def handleReturn(self):
         self.ReturnHandler()
 
-    def handleEvent(self, event):
-        if self.ColdControl.handleEvent(event):
-            return True
-        if self.HotControl.handleEvent(event):
-            return True
-        if self.RecirculationControl.handleEvent(event):
-            return True
-        if self.OutputControl.handleEvent(event):
-            return True
-        
-        if event.type == MOUSEBUTTONDOWN:
-            self.ReturnButton.handleClick(event.pos)
-        return True
+    def targets(self):
+        '''
+        (rect, handler, background) for the event dispatcher. The valve
+        controls talk to the Arduino so they run in the background.
+        '''
+        targets = [(self.ReturnButton.Rect, self.handleReturn, False)]
+        for control in (self.ColdControl, self.HotControl, self.RecirculationControl, self.OutputControl):
+            targets += [(rect, handler, True) for rect, handler in control.targets()]
+        return targets
     
     def render(self):
+        # Keeps the valve positions current (and the firmware watchdog fed)
+        # without waiting on the serial line
+        self.Controller.updateStatus(control=False)
+
         surface = pygame.surface.Surface(self.Size)
         pygame.draw.rect(surface, widgets.WHITE, (0, 0, self.Size[0], self.Size[1]))
         self.ColdControl.render(surface)
@@ -0,0 +1,203 @@
+'''
+Web dashboard for watching the controller from another device on the LAN.
+
+The controller state is pushed to browsers with server-sent events as the
+TempControl listeners get it, so viewers never cause serial traffic. Each
+update is encoded once and every viewer is sent the latest one, so a slow
+viewer skips states rather than holding anything up.
+
+Start and stop need the token from DASHBOARD_TOKEN or DASHBOARD_TOKEN_FILE:
+
+    curl -X POST -H "Authorization: Bearer <token>" http://<pi>:8080/start
+'''
+
+import asyncio
+import hmac
+import json
+import os
+import threading
+
+
+DASHBOARD_PORT = int(os.getenv("DASHBOARD_PORT", "8080"))
+DASHBOARD_TOKEN_FILE = os.path.expanduser(os.getenv("DASHBOARD_TOKEN_FILE", "~/.irrigation-dashboard-token"))
+# Sent when nothing has changed so dead connections get noticed
+KEEPALIVE = 15
+MAX_HEADER = 8192
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Irrigation Controller</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+td { padding: 0.2em 1em 0.2em 0; }
+button { font-size: 1.2em; margin-right: 1em; }
+</style>
+</head>
+<body>
+<h2>Irrigation Controller</h2>
+<table id="state"></table>
+<p><button onclick="command('start')">Start</button><button onclick="command('stop')">Stop</button></p>
+<p id="status">Connecting</p>
+<script>
+var rows = ["temperature", "setpoint", "hot", "cold", "output", "recycle", "running", "warming_up"];
+function show(state) {
+    var html = "";
+    rows.forEach(function(name) {
+        var value = state[name];
+        if (typeof value == "number" && !Number.isInteger(value)) value = value.toFixed(1);
+        html += "<tr><td>" + name + "</td><td>" + value + "</td></tr>";
+    });
+    document.getElementById("state").innerHTML = html;
+    document.getElementById("status").textContent = "Updated " + new Date(state.time*1000).toLocaleTimeString();
+}
+var events = new EventSource("/events");
+events.onmessage = function(e) { show(JSON.parse(e.data)); };
+events.onerror = function() { document.getElementById("status").textContent = "Disconnected"; };
+function command(name) {
+    var token = localStorage.getItem("token") || prompt("Token");
+    fetch("/" + name, {method: "POST", headers: {"Authorization": "Bearer " + token}}).then(function(r) {
+        if (r.status == 403) localStorage.removeItem("token");
+        else localStorage.setItem("token", token);
+        document.getElementById("status").textContent = name + ": " + r.statusText;
+    });
+}
+</script>
+</body>
+</html>
+'''
+
+
+def loadToken():
+    token = os.getenv("DASHBOARD_TOKEN")
+    if token:
+        return token
+    try:
+        with open(DASHBOARD_TOKEN_FILE) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class Dashboard(object):
+    '''
+    Runs the HTTP server on an asyncio loop in a thread of its own.
+    handler is called with 'start' or 'stop' from that thread.
+    '''
+    def __init__(self, log, handler, port=DASHBOARD_PORT, token=None):
+        self.Log = log
+        self.Handler = handler
+        self.Port = port
+        self.Token = token if token is not None else loadToken()
+        self.Loop = None
+        self.Changed = None
+        # The latest state as a ready to send event, and how many there
+        # have been
+        self.Message = None
+        self.Version = 0
+        self.Viewers = 0
+        self.Thread = threading.Thread(target=self.run, name="dashboard", daemon=True)
+
+    def start(self):
+        if not self.Port:
+            self.Log.info("Dashboard disabled")
+            return
+        self.Thread.start()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.Changed = asyncio.Condition()
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_server(self.handleConnection, port=self.Port, limit=MAX_HEADER))
+        except Exception as e:
+            self.Log.error("Dashboard failed to start on port %d: %s" % (self.Port, e))
+            return
+        # Nothing is published until the server is up
+        self.Loop = loop
+        if self.Token is None:
+            self.Log.info("Dashboard on port %d. No token, so start and stop are disabled" % self.Port)
+        else:
+            self.Log.info("Dashboard on port %d" % self.Port)
+        loop.run_until_complete(server.serve_forever())
+
+    def publish(self, state):
+        '''
+        TempControl listener. Can be called from any thread.
+        '''
+        if self.Loop is None:
+            return
+        message = ("data: %s\n\n" % json.dumps(state)).encode()
+        asyncio.run_coroutine_threadsafe(self._publish(message), self.Loop)
+
+    async def _publish(self, message):
+        async with self.Changed:
+            self.Message = message
+            self.Version += 1
+            self.Changed.notify_all()
+
+    async def handleConnection(self, reader, writer):
+        try:
+            header = await reader.readuntil(b"\r\n\r\n")
+            lines = header.decode('latin-1').split("\r\n")
+            method, path = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+
+            if method == "GET" and path == "/":
+                self.respond(writer, "200 OK", "text/html; charset=utf-8", PAGE.encode())
+            elif method == "GET" and path == "/events":
+                await self.stream(writer)
+            elif method == "POST" and path in ("/start", "/stop"):
+                if not self.authorised(headers.get("authorization", "")):
+                    self.respond(writer, "403 Forbidden")
+                else:
+                    self.Log.info("Dashboard %s from %s" % (path[1:], writer.get_extra_info('peername')))
+                    self.Handler(path[1:])
+                    self.respond(writer, "202 Accepted")
+            else:
+                self.respond(writer, "404 Not Found")
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            self.Log.error("Dashboard request failed: %s" % (e), exc_info=1)
+        finally:
+            writer.close()
+
+    def authorised(self, authorization):
+        if self.Token is None or not authorization.startswith("Bearer "):
+            return False
+        return hmac.compare_digest(authorization[len("Bearer "):].encode(), self.Token.encode())
+
+    def respond(self, writer, status, content_type="text/plain", body=None):
+        if body is None:
+            body = status.encode()
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" %
+                      (status, content_type, len(body))).encode() + body)
+
+    async def stream(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+        self.Viewers += 1
+        try:
+            sent = 0
+            while True:
+                if self.Version != sent and self.Message is not None:
+                    sent = self.Version
+                    writer.write(self.Message)
+                else:
+                    writer.write(b": keepalive\n\n")
+                await writer.drain()
+                async with self.Changed:
+                    try:
+                        await asyncio.wait_for(self.Changed.wait_for(lambda: self.Version != sent), KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.Viewers -= 1
@@ -1,21 +1,377 @@
+import base64
+import collections
 import datetime
+import gzip
+import http.client
 import json
 import os
+import threading
 import time
-
-from influxdb import InfluxDBClient
+import urllib.parse
 
 INFLUXDB_CONFIG_FILE = os.path.expanduser("~/.influxdb.config")
 
+# Cached queries are refreshed in the background once this fraction of their
+# ttl has passed, so readers normally never see an expired result
+PREFETCH_FRACTION = 0.8
+# Stale results are still returned for this many ttls while a refresh runs
+MAX_STALE_TTLS = 10
+# Wait this long before retrying a failed query
+RETRY_DELAY = 30
+
+# Points are uploaded in chunks so a failure only resends its own chunk
+WRITE_CHUNK_SIZE = 100
+WRITE_RETRIES = 3
+WRITE_TIMEOUT = 20
+# What became of a chunk. Rejected chunks (4xx) would never be accepted, so
+# they are dropped rather than holding up the points behind them.
+CHUNK_WRITTEN = "written"
+CHUNK_REJECTED = "rejected"
+CHUNK_FAILED = "failed"
+# Raw samples are reduced to min/max/mean/last per interval before they are
+# queued for upload. The raw samples are only kept locally for a short time.
+AGGREGATE_INTERVAL = 60
+RAW_WINDOW = 10*60
+
+PRECISION_MULTIPLIERS = {
+    'h': 1.0/3600,
+    'm': 1.0/60,
+    's': 1,
+    'ms': 1000,
+    'u': 1000000,
+    'n': 1000000000,
+}
+
+
+class CachedQuery(object):
+    def __init__(self, name, func, ttl):
+        self.Name = name
+        self.Func = func
+        self.TTL = ttl
+        self.Value = None
+        self.Updated = 0
+        self.Refreshing = False
+        self.Wanted = False
+        self.NextTry = 0
+
+    def age(self, now):
+        return now - self.Updated
+
+    def nextRefresh(self):
+        '''
+        Time when the query should next be refreshed
+        '''
+        due = self.Updated + self.TTL*PREFETCH_FRACTION
+        if self.Wanted:
+            due = 0
+        return max(due, self.NextTry)
+
+
+def escape(value, special):
+    value = str(value)
+    for c in special:
+        value = value.replace(c, "\\" + c)
+    return value
+
+
+def formatField(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, int):
+        return "%di" % value
+    elif isinstance(value, float):
+        return repr(value)
+    return '"%s"' % escape(value, '\\"')
+
+
+def toTimestamp(value, precision):
+    '''
+    Points can carry a datetime, an ISO string from DataSource.getTime() or
+    seconds since the epoch
+    '''
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        value = value.timestamp()
+    return int(value*PRECISION_MULTIPLIERS[precision])
+
+
+def toLineProtocol(point, precision='s'):
+    '''
+    Serialize a point in the same dict format that InfluxDBClient.write_points
+    takes straight to the Influx line protocol
+    '''
+    line = escape(point['measurement'], ', ')
+    for key, value in sorted(point.get('tags', {}).items()):
+        line += ",%s=%s" % (escape(key, ',= '), escape(value, ',= '))
+    line += " " + ",".join(["%s=%s" % (escape(key, ',= '), formatField(value))
+                            for key, value in point['fields'].items()])
+    if point.get('time') is not None:
+        line += " %d" % toTimestamp(point['time'], precision)
+    return line
+
+
+class InfluxWriter(object):
+    '''
+    Writes points with the line protocol over a single kept-alive HTTPS
+    connection. Bodies are gzipped and sent in chunks, and a failed chunk
+    is retried on its own. A chunk Influx rejects is dropped.
+    '''
+    def __init__(self, log, config, precision='s', chunk_size=WRITE_CHUNK_SIZE):
+        self.Log = log
+        self.Host = config['host']
+        self.Port = config['port']
+        self.Precision = precision
+        self.ChunkSize = chunk_size
+        self.Path = "/write?" + urllib.parse.urlencode({'db': config['database'],
+                                                        'precision': precision})
+        credentials = "%s:%s" % (config['login'], config['password'])
+        self.Headers = {
+            'Authorization': "Basic " + base64.b64encode(credentials.encode()).decode(),
+            'Content-Type': "text/plain; charset=utf-8",
+            'Content-Encoding': "gzip",
+            'Connection': "keep-alive",
+        }
+        self.Connection = None
+
+    def _connection(self):
+        if self.Connection is None:
+            self.Connection = http.client.HTTPSConnection(self.Host, self.Port, timeout=WRITE_TIMEOUT)
+        return self.Connection
+
+    def _reset(self):
+        try:
+            self.Connection.close()
+        except Exception:
+            pass
+        self.Connection = None
+
+    def writeChunk(self, lines):
+        body = gzip.compress("\n".join(lines).encode('utf-8'))
+        for x in range(WRITE_RETRIES):
+            try:
+                connection = self._connection()
+                connection.request("POST", self.Path, body, self.Headers)
+                response = connection.getresponse()
+                # The body has to be read before the connection can be reused
+                message = response.read()
+                if response.status == 204:
+                    return CHUNK_WRITTEN
+                self.Log.error("Influxdb write failed (%d): %s"%(response.status, message[:200]))
+                if 400 <= response.status < 500:
+                    # Retrying a rejected chunk won't help
+                    return CHUNK_REJECTED
+            except Exception as e:
+                self.Log.error("Influxdb write failure: %s"%(e))
+                self._reset()
+            time.sleep(0.2)
+        return CHUNK_FAILED
+
+    def write(self, points):
+        '''
+        Returns (written, rejected), the number of points from the start of
+        the list that were written or dropped. Stops at the first chunk that
+        fails so ordering is kept.
+        '''
+        written = 0
+        rejected = 0
+        for start in range(0, len(points), self.ChunkSize):
+            chunk = points[start:start+self.ChunkSize]
+            try:
+                lines = [toLineProtocol(p, self.Precision) for p in chunk]
+            except Exception as e:
+                self.Log.error("Dropping %d points that can't be serialized: %s"%(len(chunk), e))
+                rejected += len(chunk)
+                continue
+            result = self.writeChunk(lines)
+            if result == CHUNK_FAILED:
+                break
+            if result == CHUNK_REJECTED:
+                self.Log.error("Dropping %d points rejected by Influx"%len(chunk))
+                rejected += len(chunk)
+            else:
+                written += len(chunk)
+        return written, rejected
+
+
+class Aggregator(object):
+    '''
+    Reduces samples to one point per series per interval. Numeric fields
+    become <field>_min, <field>_max, <field>_mean and <field>_last, anything
+    else only keeps its last value. A series is a measurement and its tags.
+    '''
+    def __init__(self, interval=AGGREGATE_INTERVAL, raw_window=RAW_WINDOW):
+        self.Interval = interval
+        self.RawWindow = raw_window
+        self.Raw = collections.deque()
+        # (measurement, tags) -> [interval start, {field: [min, max, sum, count, last]}]
+        self.Buckets = {}
+
+    def _point(self, key, bucket):
+        measurement, tags = key
+        start, stats = bucket
+        fields = {}
+        for name, (low, high, total, count, last) in stats.items():
+            if count:
+                fields[name + "_min"] = low
+                fields[name + "_max"] = high
+                fields[name + "_mean"] = total/count
+            fields[name + "_last"] = last
+        return {
+            'measurement': measurement,
+            'tags': dict(tags),
+            'time': start,
+            'fields': fields,
+        }
+
+    def add(self, measurement, fields, tags=None, t=None):
+        '''
+        Add a sample. Returns the points for any intervals it completed.
+        '''
+        if t is None:
+            t = time.time()
+        tags = tags or {}
+        self.Raw.append((t, measurement, tags, fields))
+        while self.Raw and self.Raw[0][0] < t - self.RawWindow:
+            self.Raw.popleft()
+
+        points = []
+        key = (measurement, tuple(sorted(tags.items())))
+        start = t - t % self.Interval
+        bucket = self.Buckets.get(key)
+        if bucket is None or bucket[0] != start:
+            if bucket is not None:
+                points.append(self._point(key, bucket))
+            bucket = [start, {}]
+            self.Buckets[key] = bucket
+
+        stats = bucket[1]
+        for name, value in fields.items():
+            stat = stats.get(name)
+            if stat is None:
+                stat = [None, None, 0.0, 0, value]
+                stats[name] = stat
+            stat[4] = value
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stat[0] = value if stat[0] is None else min(stat[0], value)
+                stat[1] = value if stat[1] is None else max(stat[1], value)
+                stat[2] += value
+                stat[3] += 1
+        return points
 
+    def flush(self, now=None):
+        '''
+        Return the points for intervals that have ended, so series that stop
+        getting samples are still sent
+        '''
+        if now is None:
+            now = time.time()
+        points = []
+        for key, bucket in list(self.Buckets.items()):
+            if bucket[0] + self.Interval <= now:
+                points.append(self._point(key, bucket))
+                del self.Buckets[key]
+        return points
 
-class DataSource(object):
+    def raw(self, since=0):
+        return [sample for sample in self.Raw if sample[0] >= since]
+
+
+class QueryCache(object):
+    '''
+    Query results are cached and refreshed from the data thread so that the
+    UI never waits on Influx
+    '''
     def __init__(self, log):
         self.Log = log
+        self.Queries = {}
+        self.QueryLock = threading.Condition()
+        self.Wakeup = threading.Event()
+
+    def addQuery(self, name, func, ttl):
+        '''
+        Register a query to be cached for ttl seconds and refreshed in the
+        background by prefetch()
+        '''
+        self.Queries[name] = CachedQuery(name, func, ttl)
+
+    def getCached(self, name):
+        '''
+        Return the cached result without blocking. A stale result is returned
+        while a refresh is requested in the background, and None once it is
+        too old to be useful or there has never been a result.
+        '''
+        query = self.Queries[name]
+        now = time.time()
+        if query.age(now) > query.TTL:
+            # Only wake the data thread if it isn't already on it or waiting
+            # to retry a failed query, otherwise it would be woken every frame
+            if not query.Wanted and not query.Refreshing and query.NextTry <= now:
+                query.Wanted = True
+                self.Wakeup.set()
+            if query.age(now) > query.TTL*MAX_STALE_TTLS:
+                return None
+        return query.Value
+
+    def refresh(self, name):
+        '''
+        Run a query and update its cached result. Concurrent refreshes of the
+        same query are coalesced: a caller that finds one in flight waits for
+        it instead of sending a second query.
+        '''
+        query = self.Queries[name]
+        with self.QueryLock:
+            if query.Refreshing:
+                self.QueryLock.wait_for(lambda: not query.Refreshing)
+                return query.Value
+            query.Refreshing = True
+            query.Wanted = False
+
+        try:
+            value = query.Func()
+        except Exception as e:
+            self.Log.error("Query %s failed: %s"%(name, str(e)))
+            value = None
+
+        with self.QueryLock:
+            if value is not None:
+                query.Value = value
+                query.Updated = time.time()
+            else:
+                query.NextTry = time.time() + RETRY_DELAY
+            query.Refreshing = False
+            self.QueryLock.notify_all()
+        return query.Value
+
+    def prefetch(self):
+        '''
+        Refresh any query that is close to expiring or was asked for
+        '''
+        self.Wakeup.clear()
+        now = time.time()
+        for name, query in self.Queries.items():
+            if query.nextRefresh() <= now:
+                self.refresh(name)
+
+    def nextPrefetch(self):
+        '''
+        Seconds until the next query needs refreshing
+        '''
+        now = time.time()
+        return max(min([q.nextRefresh() for q in self.Queries.values()]) - now, 0)
+
+
+class DataSource(QueryCache):
+    def __init__(self, log):
+        QueryCache.__init__(self, log)
         self.Log.info("Reading InfluxDB config from %s"%(INFLUXDB_CONFIG_FILE))
         with open(INFLUXDB_CONFIG_FILE) as f:
             config = json.load(f)
 
+        # Imported here as it pulls in a lot and is only needed for queries
+        from influxdb import InfluxDBClient
         self.Influx = InfluxDBClient(config['host'],
                                      config['port'],
                                      config['login'],
@@ -23,60 +379,87 @@ class DataSource(object):
                                      config['database'],
                                      ssl=True,
                                      timeout=60)
+        self.Writer = InfluxWriter(self.Log, config, config.get('precision', 's'))
         self.Points = []
+        self.PointsLock = threading.Lock()
+        self.Aggregator = Aggregator()
         self.LastSent = datetime.datetime.now()
         self.Interval = 60
         self.MaxPoints = 250
 
+        self.addQuery('temperature', self.queryCurrentTemps, 60)
+        self.addQuery('humidity', self.queryCurrentHumidty, 60)
+
     def getTime(self):
         now = datetime.datetime.utcnow()
         return now.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-    # def queryCurrentTemps(self):
-    #     r = self.query('''SELECT "sensor","value" FROM "temperature_fahrenheit" WHERE ("location" = 'dryer') AND time >= now() - 5m GROUP BY "sensor" ORDER by time DESC''')
-    #     points = [p for p in r]
-    #     result = {}
-    #     self.Log.debug("Temperature data: %s"%points)
-    #     for sensor_data in points:
-    #         if len(sensor_data) > 0:
-    #             result[sensor_data[0]['sensor']] = int(sensor_data[0]['value'])
-    #     # self.Log.debug("temp result: %s"%result)
-    #     return result
-
-    # def queryCurrentHumidty(self):
-    #     r = self.query('''SELECT "sensor","value" FROM "humidity_percentage" WHERE ("location" = 'dryer') AND time >= now() - 5m GROUP BY "sensor" ORDER by time DESC''')
-    #     points = [p for p in r]
-    #     self.Log.debug("Humidity data: %s"%points)
-    #     result = {}
-    #     for sensor_data in points:
-    #         if len(sensor_data) > 0:
-    #             result[sensor_data[0]['sensor']] = int(sensor_data[0]['value'])
-    #     # self.Log.debug("humidity result: %s"%result)
-    #     return result
+    def queryCurrentTemps(self):
+        r = self.query('''SELECT "sensor","value" FROM "temperature_fahrenheit" WHERE ("location" = 'dryer') AND time >= now() - 5m GROUP BY "sensor" ORDER by time DESC''')
+        points = [p for p in r]
+        result = {}
+        self.Log.debug("Temperature data: %s"%points)
+        for sensor_data in points:
+            if len(sensor_data) > 0:
+                result[sensor_data[0]['sensor']] = int(sensor_data[0]['value'])
+        # self.Log.debug("temp result: %s"%result)
+        return result
 
-    def writePoints(self):
-        ret = None
+    def queryCurrentHumidty(self):
+        r = self.query('''SELECT "sensor","value" FROM "humidity_percentage" WHERE ("location" = 'dryer') AND time >= now() - 5m GROUP BY "sensor" ORDER by time DESC''')
+        points = [p for p in r]
+        self.Log.debug("Humidity data: %s"%points)
+        result = {}
+        for sensor_data in points:
+            if len(sensor_data) > 0:
+                result[sensor_data[0]['sensor']] = int(sensor_data[0]['value'])
+        # self.Log.debug("humidity result: %s"%result)
+        return result
 
-        # drop old points if there are too many
-        if len(self.Points) > self.MaxPoints:
-            self.Points = self.Points[self.MaxPoints:]
+    def addSample(self, measurement, fields, tags=None, t=None):
+        '''
+        Samples can come in at any rate, only the per interval aggregates are
+        queued for Influx
+        '''
+        with self.PointsLock:
+            self.Points.extend(self.Aggregator.add(measurement, fields, tags, t))
 
-        for x in range(10):
-            try:
-                ret = self.Influx.write_points(self.Points)
-            except Exception as e:
-                self.Log.error("Influxdb point failure: %s"%(e))
-                ret = 0
-            if ret:
-                self.Log.info("%s - Sent %d points to Influx"%(datetime.datetime.now(), len(self.Points)))
-                self.LastSent = datetime.datetime.now()
-                self.Points = []
-                return ret
+    def flushSamples(self):
+        with self.PointsLock:
+            self.Points.extend(self.Aggregator.flush())
 
-            time.sleep(0.2)
+    def backlog(self, now=None):
+        '''
+        Seconds since the oldest point waiting to be sent, 0 when there
+        aren't any
+        '''
+        if now is None:
+            now = time.time()
+        with self.PointsLock:
+            if not self.Points:
+                return 0
+            oldest = self.Points[0]['time']
+        return max(now - toTimestamp(oldest, 's'), 0)
+
+    def writePoints(self):
+        with self.PointsLock:
+            # drop old points if there are too many
+            if len(self.Points) > self.MaxPoints:
+                self.Points = self.Points[-self.MaxPoints:]
+            points = list(self.Points)
 
-        self.Log.error("%s - Failed to send %d points to Influx: %s"%(datetime.datetime.now(), len(self.Points), ret))
-        return ret
+        written, rejected = self.Writer.write(points)
+        with self.PointsLock:
+            # Points that made it or were rejected are removed, the rest go
+            # next time. Points are only ever appended while writing.
+            self.Points = self.Points[written + rejected:]
+        if written:
+            self.Log.info("%s - Sent %d points to Influx"%(datetime.datetime.now(), written))
+            self.LastSent = datetime.datetime.now()
+        failed = len(points) - written - rejected
+        if failed:
+            self.Log.error("%s - Failed to send %d points to Influx"%(datetime.datetime.now(), failed))
+        return failed == 0
 
     def query(self, *args, **kwargs):
         for x in range(3):
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+
+import pygame
+from pygame.locals import *
+
+
+# Touch screens tend to report one tap as several presses
+DEBOUNCE = 0.25
+# Size of the hit test grid cells (pixels)
+GRID_CELL = 80
+
+
+class CommandWorker(object):
+    '''
+    Runs handlers that talk to the hardware on a thread of their own, one at
+    a time and in the order they were submitted, so the UI never waits on
+    serial I/O.
+    '''
+    def __init__(self, log):
+        self.Log = log
+        self.Queue = queue.Queue()
+        self.Busy = False
+        self.Thread = threading.Thread(target=self.run, name="commands", daemon=True)
+        self.Thread.start()
+
+    def submit(self, func, *args):
+        self.Queue.put((func, args))
+
+    def depth(self):
+        return self.Queue.qsize()
+
+    def run(self):
+        while True:
+            func, args = self.Queue.get()
+            self.Busy = True
+            try:
+                func(*args)
+            except Exception as e:
+                self.Log.error("Command %s failed: %s" % (getattr(func, '__name__', func), e), exc_info=1)
+            self.Busy = False
+
+
+class Target(object):
+    def __init__(self, rect, handler, background):
+        self.Rect = pygame.Rect(rect)
+        self.Handler = handler
+        self.Background = background
+        self.LastPress = 0
+
+
+class HitIndex(object):
+    '''
+    Targets bucketed by the grid cells their rects cover, so finding what
+    was touched only checks the targets in one cell
+    '''
+    def __init__(self, cell=GRID_CELL):
+        self.Cell = cell
+        self.Grid = {}
+
+    def _cells(self, rect):
+        for x in range(rect.left//self.Cell, (rect.right - 1)//self.Cell + 1):
+            for y in range(rect.top//self.Cell, (rect.bottom - 1)//self.Cell + 1):
+                yield (x, y)
+
+    def add(self, target):
+        for cell in self._cells(target.Rect):
+            self.Grid.setdefault(cell, []).append(target)
+
+    def remove(self, target):
+        for cell in self._cells(target.Rect):
+            self.Grid[cell].remove(target)
+
+    def find(self, pos):
+        cell = (int(pos[0])//self.Cell, int(pos[1])//self.Cell)
+        # Later targets are drawn on top, so they win
+        for target in reversed(self.Grid.get(cell, [])):
+            if target.Rect.collidepoint(pos):
+                return target
+        return None
+
+
+class EventDispatcher(object):
+    '''
+    Routes touches to the target under them. Targets are grouped in layers
+    (one per screen). A press fires its target straight away unless it is a
+    bounce of the previous press. Handlers marked background are run on the
+    CommandWorker.
+    '''
+    def __init__(self, log, worker):
+        self.Log = log
+        self.Worker = worker
+        self.Layers = {}
+        self.Pressed = {}
+
+    def add(self, layer, rect, handler, background=False):
+        target = Target(rect, handler, background)
+        self.Layers.setdefault(layer, HitIndex()).add(target)
+        return target
+
+    def move(self, layer, target, rect):
+        rect = pygame.Rect(rect)
+        if rect == target.Rect:
+            return
+        index = self.Layers[layer]
+        index.remove(target)
+        target.Rect = rect
+        index.add(target)
+
+    def dispatch(self, layer, event, now=None):
+        '''
+        Returns True if the event hit a target
+        '''
+        if now is None:
+            now = time.time()
+
+        if event.type == MOUSEBUTTONUP:
+            return self.Pressed.pop(event.button, None) is not None
+
+        if event.type != MOUSEBUTTONDOWN or layer not in self.Layers:
+            return False
+
+        target = self.Layers[layer].find(event.pos)
+        if target is None:
+            return False
+        self.Pressed[event.button] = target
+
+        if now - target.LastPress < DEBOUNCE:
+            return True
+        target.LastPress = now
+
+        if target.Background:
+            self.Worker.submit(target.Handler)
+        else:
+            target.Handler()
+        return True
@@ -1,5 +1,9 @@
 #! /usr/bin/env python3
 
+import time
+# Taken before anything heavy is imported for the startup timing
+IMPORT_TIME = time.time()
+
 import pygame
 from pygame.locals import *
 import logging
@@ -7,13 +11,18 @@ import logging.handlers
 import os
 import subprocess
 import sys
-import time
 import threading
 
 
 # Local imports
+import alarms
+import archive
 import control
+import dashboard
 import data
+import events
+import journal
+import profiler
 import widgets
 
 PRODUCTION = os.getenv("PRODUCTION")
@@ -28,24 +37,49 @@ SLEEP_DELAY = 15*60
 SCREEN_ON = os.path.join(BASE_DIR, "screen-on.sh")
 SCREEN_OFF = os.path.join(BASE_DIR, "screen-off.sh")
 
+FRAME_RATE = 30
+
 DATA_INTERVAL = 1*60
+# Run for every alarm raised or cleared, see alarms.commandNotifier
+ALARM_COMMAND = os.getenv("ALARM_COMMAND")
+# Posted by the dashboard thread so remote commands are handled in the main
+# loop like a touch
+REMOTE_COMMAND = pygame.USEREVENT + 1
+
+# Three taps in the top left corner within this time show the debug overlay
+DEBUG_TAPS = 3
+DEBUG_TAP_TIME = 1.5
+DEBUG_CORNER = (0, 0, 60, 60)
+TELEMETRY_MEASUREMENT = "irrigation_controller"
+
+
+def startupTimes():
+    '''
+    Seconds since this process and the system started. Falls back to the
+    time since this module was imported without /proc.
+    '''
+    now = time.time()
+    try:
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        with open("/proc/self/stat") as f:
+            # The fields after the command name, which can contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        process_start = float(fields[19])/os.sysconf("SC_CLK_TCK")
+        return (uptime - process_start, uptime)
+    except Exception:
+        return (now - IMPORT_TIME, None)
 
 
 class App(object):
     def __init__(self, log):
         self.Log = log
-
-        self.DataSource = data.DataSource(self.Log)
-        # self.Temp = self.DataSource.queryCurrentTemps()
-        self.Temp = {}
-        self.Humidity = {}
         self.InSettings = False
-        self.DataThread = threading.Thread(target=self.dataDaemon, args=(DATA_INTERVAL,), daemon=True)
-        self.DataThread.start()
-
         self.Sleeping = False
+        self.WakePress = None
         self.LastMovement = time.time()
 
+        # Get something on the screen before anything slow happens
         if PRODUCTION:
             # Work around for bug in libsdl
             os.environ['SDL_VIDEO_WINDOW_POS'] = "{0},{1}".format(0, 0)
@@ -59,44 +93,212 @@ class App(object):
             pygame.init()
             self.Screen = pygame.display.set_mode(SCREEN_SIZE)
 
-        self.Clock = pygame.time.Clock()
+        # The default font doesn't need the system font scan that SysFont does
+        self.SplashFont = pygame.font.Font(None, 36)
+        self.Progress = {'Arduino': "Connecting", 'Influx': "Connecting"}
+        self.StartupError = None
+        self.Ready = False
+        self.renderSplash()
+        process_time, boot_time = startupTimes()
+        self.Log.info("First frame %.2fs after process start (%s after boot)" %
+                      (process_time, "%.2fs" % boot_time if boot_time is not None else "unknown"))
+
+        # The hardware and Influx connections are slow, so they happen in the
+        # background while the splash screen shows their progress
+        self.DataSource = None
+        self.DataThread = threading.Thread(target=self.dataDaemon, args=(DATA_INTERVAL,), name="data", daemon=True)
+        self.DataThread.start()
 
-        self.Background = pygame.image.load(BACKGROUND_IMAGE)
+        self.Arduino = control.Arduino(self.Log, connect=False)
+        # The serial connection starts straight away, the valves are checked
+        # once the widgets below exist
+        self.WidgetsReady = threading.Event()
+        self.HardwareThread = threading.Thread(target=self.startHardware, name="hardware", daemon=True)
+        self.HardwareThread.start()
+
+        self.Clock = pygame.time.Clock()
+        self.FrameTime = 0
+        self.Debug = False
+        self.DebugTaps = []
+        self.Profiler = profiler.SamplingProfiler(self.Log)
+        self.Profiler.install()
+
+        # Converted to the display's format once, an unconverted image is
+        # converted again on every blit
+        self.Background = pygame.image.load(BACKGROUND_IMAGE).convert()
         self.PowerButton = widgets.PowerButton((SCREEN_SIZE[0]-55, 5), self.handlePower)
         self.SettingsButton = widgets.SettingsButton((SCREEN_SIZE[0] - (55*2),5), self.handleSettings)
         self.Font = pygame.font.SysFont("avenir", 18)
 
-        self.Arduino = control.Arduino(self.Log)
         self.TempController = control.TempControl(self.Log, self.Arduino, self.Screen)
-        self.Settings = control.Settings(self.Log, self.Screen, self.Arduino, self.handleSettings)
+        # Local history that doesn't depend on Influx
+        self.Archive = archive.Archive(self.Log)
+        now = time.time()
+        self.TempController.seed(self.Archive.query(now - control.HISTORY_SIZE, now))
+        self.TempController.addListener(self.Archive.add)
+        self.Journal = journal.StateJournal(self.Log)
+        self.TempController.addListener(self.recordState)
+        self.TempController.addListener(self.journalState)
+        self.Alarms = alarms.AlarmEngine(self.Log, alarms.defaultRules(self.TempController.TempThreshold))
+        if ALARM_COMMAND:
+            self.Alarms.addNotifier(alarms.commandNotifier(ALARM_COMMAND))
+        self.AlarmBanner = widgets.AlarmBanner((0, SCREEN_SIZE[1] - 30), (SCREEN_SIZE[0], 30), self.Alarms.messages)
+        self.TempController.addListener(self.checkAlarms)
+        self.Settings = control.Settings(self.Log, self.Screen, self.Arduino, self.TempController, self.handleSettings)
 
         #
         # Sensor Widgets
         #
 
         self.TimerControl = widgets.TimerControl((250,5),
-                                                 self.TempController.handleStart,
-                                                 self.TempController.handleStop)
+                                                 self.handleStart,
+                                                 self.handleStop)
         # Position will get updated on first render
         self.StartStop = widgets.StartStopButton((250,5), self.TimerControl.start, self.TimerControl.stop)
 
+        self.Dashboard = dashboard.Dashboard(self.Log, self.postRemoteCommand)
+        self.TempController.addListener(self.Dashboard.publish)
+        self.Dashboard.start()
+
+        # Touches are routed through a hit test index instead of asking
+        # every widget. Anything that talks to the Arduino runs on the
+        # command worker so a press never waits on the serial line.
+        self.Worker = events.CommandWorker(self.Log)
+        self.Dispatcher = events.EventDispatcher(self.Log, self.Worker)
+        self.Dispatcher.add('main', self.PowerButton.Rect, self.handlePower)
+        self.Dispatcher.add('main', self.SettingsButton.Rect, self.handleSettings)
+        self.Dispatcher.add('main', DEBUG_CORNER, self.handleDebugTap)
+        self.DebugOverlay = widgets.DebugOverlay((10, 60), 380)
+        self.StartStopTarget = self.Dispatcher.add('main', self.StartStop.hitRect(), self.StartStop.toggle)
+        for rect, handler, background in self.Settings.targets():
+            self.Dispatcher.add('settings', rect, handler, background)
+        self.WidgetsReady.set()
+
+    def startHardware(self):
+        try:
+            self.Arduino.connect()
+            self.Progress['Arduino'] = "Checking valves"
+            self.WidgetsReady.wait()
+            saved = self.Journal.load()
+            if self.TempController.initialise(saved):
+                self.TimerControl.resume(saved['start_time'])
+                self.StartStop.On = True
+            self.journalState(self.TempController.getState())
+            self.Progress['Arduino'] = "Ready"
+            self.Ready = True
+            self.Log.info("Ready %.2fs after process start" % startupTimes()[0])
+        except Exception as e:
+            self.Progress['Arduino'] = "Failed"
+            self.StartupError = e
+
+    def renderSplash(self):
+        self.Screen.fill(widgets.WHITE)
+        lines = ["Irrigation Controller starting"]
+        lines += ["%s: %s" % item for item in sorted(self.Progress.items())]
+        y = 150
+        for line in lines:
+            text = self.SplashFont.render(line, 1, widgets.BLACK)
+            self.Screen.blit(text, (SCREEN_SIZE[0]/2 - text.get_size()[0]/2, y))
+            y += 50
+        pygame.display.flip()
 
     def dataDaemon(self, interval):
+        try:
+            self.DataSource = data.DataSource(self.Log)
+            self.Progress['Influx'] = "Ready"
+        except Exception as e:
+            # Irrigation doesn't depend on Influx, so carry on without it
+            self.Log.error("Failed to start the data source: %s"%str(e), exc_info=1)
+            self.Progress['Influx'] = "Failed"
+            return
+
+        last_write = time.time()
         while True:
             try:
-                # self.Temp = self.DataSource.queryCurrentTemps()
-                # self.Humidity = self.DataSource.queryCurrentHumidty()
-                # self.Log.debug("DataDaemon: %s, %s"%(self.Temp, self.Humidity))
-                time.sleep(interval)
+                # Keep the cached queries fresh. Wakes early when the UI
+                # finds a stale result
+                self.DataSource.prefetch()
+
+                now = time.time()
+                if now - last_write >= interval:
+                    self.DataSource.flushSamples()
+                    self.DataSource.writePoints()
+                    last_write = now
+
+                next_write = interval - (time.time() - last_write)
+                self.DataSource.Wakeup.wait(max(min(self.DataSource.nextPrefetch(), next_write), 0))
             except Exception as e:
                 self.Log.error("Daemon error: %s"%str(e))
+                time.sleep(interval)
+
+    def handleStart(self):
+        self.Worker.submit(self.startController)
+
+    def handleStop(self):
+        self.Worker.submit(self.stopController)
+
+    def startController(self):
+        self.TempController.handleStart()
+        self.journalState(self.TempController.getState())
+
+    def stopController(self):
+        self.TempController.handleStop()
+        self.journalState(self.TempController.getState())
+
+    def journalState(self, state):
+        # Only what is needed to resume a run, so the journal only gets
+        # rewritten when something meaningful changes
+        self.Journal.write({
+            'running': state['running'],
+            'start_time': self.TimerControl.StartTime,
+            'warming_up': state['warming_up'],
+            'hot': round(state['hot']),
+            'cold': round(state['cold']),
+            'setpoint': state['setpoint'],
+        })
+
+    def checkAlarms(self, state):
+        state = dict(state)
+        state['rtt'] = self.Arduino.RTT.last() or 0
+        state['backlog'] = self.DataSource.backlog(state['time']) if self.DataSource is not None else 0
+        state['last_failure'] = self.Arduino.LastFailure
+        state['last_reset'] = self.Arduino.LastReset
+        self.Alarms.update(state)
+
+    def recordState(self, state):
+        fields = {
+            'temperature': state['temperature'],
+            'hot': state['hot'],
+            'cold': state['cold'],
+            'output': int(state['output']),
+            'recycle': int(state['recycle']),
+            'running': int(state['running']),
+        }
+        for name in ('hot_supply', 'cold_supply'):
+            if state[name] is not None:
+                fields[name] = state[name]
+        if self.DataSource is not None:
+            self.DataSource.addSample(TELEMETRY_MEASUREMENT, fields, t=state['time'])
+
+    def renderClimate(self):
+        if self.DataSource is None:
+            return
+        # Only ever reads the cache, so a slow Influx can't hold up a frame
+        temps = self.DataSource.getCached('temperature')
+        humidity = self.DataSource.getCached('humidity')
+        text = "Room: %s F  %s %%" % (self.average(temps), self.average(humidity))
+        self.Screen.blit(self.Font.render(text, 1, widgets.BLACK), (420, 420))
+
+    def average(self, sensors):
+        if not sensors:
+            return "--"
+        return "%d" % (sum(sensors.values())/len(sensors))
 
     def handlePower(self):
         if self.Sleeping:
             self.wakeUp()
         else:
             self.sleep()
-            time.sleep(0.5)
 
     def wakeUp(self):
         self.Log.info("Wakeup!")
@@ -110,6 +312,34 @@ class App(object):
         if PRODUCTION:
             subprocess.run(SCREEN_OFF, shell=False)
 
+    def handleDebugTap(self):
+        now = time.time()
+        self.DebugTaps = [t for t in self.DebugTaps if now - t < DEBUG_TAP_TIME] + [now]
+        if len(self.DebugTaps) >= DEBUG_TAPS:
+            self.DebugTaps = []
+            self.Debug = not self.Debug
+
+    def debugLines(self):
+        rtt = self.Arduino.RTT
+        lines = [
+            "FPS %.1f  frame %.1f ms" % (self.Clock.get_fps(), self.FrameTime*1000),
+            "Serial RTT %.1f ms  mean %.1f ms" % ((rtt.last() or 0)*1000, (rtt.mean() or 0)*1000),
+            "Commands queued %d%s" % (self.Worker.depth(), " (busy)" if self.Worker.Busy else ""),
+        ]
+        if self.DataSource is not None:
+            lines.append("Influx points queued %d" % len(self.DataSource.Points))
+        for name, function in sorted(profiler.currentFunctions().items()):
+            lines.append("%s: %s" % (name, function))
+        return lines
+
+    def postRemoteCommand(self, command):
+        pygame.event.post(pygame.event.Event(REMOTE_COMMAND, command=command))
+
+    def handleRemoteCommand(self, command):
+        # The same as pressing START/STOP, so the button and timer follow
+        if (command == 'start') != self.StartStop.On:
+            self.StartStop.toggle()
+
     def handleSettings(self):
         # Toggle settings mode
         self.InSettings = not self.InSettings
@@ -117,63 +347,97 @@ class App(object):
     def handleEvents(self):
         now = time.time()
         for event in pygame.event.get():
-            if self.Sleeping:
-                self.LastMovement = now
-                self.wakeUp()
-                pygame.event.clear()
-                return True
-
-            # self.Log.debug("Event: %d,%d"%event.pos)
-            # self.Log.debug("Mouse: %d,%d"%pygame.mouse.get_pos())
-
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_q:
-                    pygame.event.clear()
-                    return False
-
             if event.type == QUIT:
                 return False
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_q:
+                return False
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_d:
+                self.Debug = not self.Debug
+            if event.type == REMOTE_COMMAND:
+                self.handleRemoteCommand(event.command)
+                continue
+
+            if event.type == MOUSEBUTTONDOWN:
+                self.LastMovement = now
+                if self.Sleeping:
+                    # The touch that wakes the screen doesn't press
+                    # whatever is under it
+                    self.wakeUp()
+                    self.WakePress = event.button
+                    continue
+            elif event.type == MOUSEBUTTONUP and self.WakePress == event.button:
+                self.WakePress = None
+                continue
 
             if self.InSettings:
-                # self.Log.debug("In settings")
-                self.Settings.handleEvent(event)
+                self.Dispatcher.dispatch('settings', event, now)
             else:
-                if event.type == MOUSEBUTTONDOWN:
-                    self.LastMovement = now
-                    # self.Log.debug("Event pos: %d,%d"%(event.pos))
-                    # self.Log.debug("Start Rect: %s"%(self.StartStop.Rectangle))
-                    self.PowerButton.handleClick(event.pos)
-                    self.SettingsButton.handleClick(event.pos)
-                    self.StartStop.handleClick(event.pos)
-                    self.TempController.handleEvent(event)
-
-            pygame.event.clear()
+                self.Dispatcher.dispatch('main', event, now)
 
         if now - self.LastMovement > SLEEP_DELAY and not self.Sleeping:
             self.sleep()
 
         return True
 
-    def run(self):
-        while True:
-            self.Clock.tick(30)
-            if not self.handleEvents():
-                return
+    def waitForStartup(self):
+        '''
+        Show the splash screen until the hardware is ready. Returns False if
+        asked to quit in the meantime.
+        '''
+        while not self.Ready:
+            self.Clock.tick(10)
+            if self.StartupError is not None:
+                raise self.StartupError
+            for event in pygame.event.get():
+                if event.type == QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_q):
+                    return False
+            self.renderSplash()
+        return True
 
+    def renderBackground(self):
+        self.Screen.blit(self.Background, (0,0))
 
-            if self.InSettings:
-                # self.Log.debug("FIXME: Settings")
-                self.Settings.render()
-            else:
-                self.Screen.blit(self.Background, (0,0))
-                self.PowerButton.render(self.Screen)
-                self.SettingsButton.render(self.Screen)
-                self.TimerControl.render(self.Screen)
-                self.StartStop.Position = (250+self.TimerControl.Rectangle.size[0], 5)
-                self.StartStop.render(self.Screen)
-                self.TempController.render()
+    def render(self):
+        if self.InSettings:
+            # self.Log.debug("FIXME: Settings")
+            self.Settings.render()
+        else:
+            self.renderBackground()
+            self.PowerButton.render(self.Screen)
+            self.SettingsButton.render(self.Screen)
+            self.TimerControl.render(self.Screen)
+            self.StartStop.Position = (250+self.TimerControl.Rectangle.size[0], 5)
+            self.Dispatcher.move('main', self.StartStopTarget, self.StartStop.hitRect())
+            self.StartStop.render(self.Screen)
+            self.TempController.render()
+            self.renderClimate()
+
+        self.AlarmBanner.render(self.Screen)
+        if self.Debug:
+            self.DebugOverlay.render(self.Screen, self.debugLines())
+
+        pygame.display.flip()
+
+    def frame(self):
+        '''
+        Handle the pending events and draw one frame. Returns False when
+        asked to quit.
+        '''
+        start = time.time()
+        if not self.handleEvents():
+            return False
+        self.render()
+        self.FrameTime = time.time() - start
+        return True
+
+    def run(self):
+        if not self.waitForStartup():
+            return
 
-            pygame.display.flip()
+        while True:
+            self.Clock.tick(FRAME_RATE)
+            if not self.frame():
+                return
 
 
 
@@ -195,6 +459,7 @@ if __name__ == "__main__":
     try:
         app = App(log)
         app.run()
+        app.Archive.flush()
     except Exception as e:
         log.error("Main loop failed: %s"%(e), exc_info=1)
         sys.exit(1)
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+import time
+
+
+STATE_FILE = os.path.expanduser("~/.irrigation-state.json")
+# The types each field of a journaled state can have
+FIELDS = {
+    'saved': (int, float),
+    'running': (bool,),
+    'start_time': (int, float, type(None)),
+    'warming_up': (bool,),
+    'hot': (int, float),
+    'cold': (int, float),
+    'setpoint': (int, float),
+}
+
+
+class StateJournal(object):
+    '''
+    Keeps the last controller state on disk so that a restart can pick up
+    a run that was in progress. The file is only rewritten when the state
+    changes, and always replaced atomically so a crash mid-write leaves the
+    previous state intact.
+    '''
+    def __init__(self, log, path=STATE_FILE):
+        self.Log = log
+        self.Path = path
+        self.Last = None
+        # Written from the command worker and the UI thread, which would
+        # otherwise share the temporary file
+        self.Lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.Path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.Log.error("Failed to read state journal %s: %s" % (self.Path, e))
+            return None
+        problem = self.check(state)
+        if problem is not None:
+            self.Log.error("Ignoring state journal %s: %s" % (self.Path, problem))
+            return None
+        self.Last = dict(state)
+        del self.Last['saved']
+        return state
+
+    def check(self, state):
+        '''
+        Returns what is wrong with a loaded state, or None if it can be used
+        '''
+        if not isinstance(state, dict):
+            return "not an object"
+        for name, types in FIELDS.items():
+            if name not in state:
+                return "no %s" % name
+            if not isinstance(state[name], types):
+                return "%s is %r" % (name, state[name])
+        if state['running'] and state['start_time'] is None:
+            return "running without a start time"
+        return None
+
+    def write(self, state):
+        with self.Lock:
+            if state == self.Last:
+                return False
+
+            saved = dict(state)
+            saved['saved'] = time.time()
+            tmp_file = self.Path + ".tmp"
+            try:
+                with open(tmp_file, "w") as f:
+                    json.dump(saved, f)
+                os.replace(tmp_file, self.Path)
+            except Exception as e:
+                self.Log.error("Failed to write state journal %s: %s" % (self.Path, e))
+                return False
+            self.Last = dict(state)
+            return True
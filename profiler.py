@@ -0,0 +1,100 @@
+'''
+On demand sampling profiler.
+
+Nothing runs until the process gets SIGUSR1. Then the stacks of every thread
+are sampled for a while and written out in the collapsed format that
+flamegraph.pl and speedscope read:
+
+    kill -USR1 <pid>
+    flamegraph.pl ~/logs/irrigation-profile-*.folded > profile.svg
+'''
+
+import os
+import signal
+import sys
+import threading
+import time
+
+
+PROFILE_DIR = "~/logs"
+SAMPLE_INTERVAL = 0.005
+SAMPLE_DURATION = 10
+
+
+def threadNames():
+    return dict((thread.ident, thread.name) for thread in threading.enumerate())
+
+
+def frameName(frame):
+    code = frame.f_code
+    return "%s:%s" % (os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name)
+
+
+def collapse(frame):
+    '''
+    Outermost call first, separated by ';'
+    '''
+    names = []
+    while frame is not None:
+        names.append(frameName(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def currentFunctions():
+    '''
+    Thread name -> the function it is running now, for a quick look at what
+    each thread is up to
+    '''
+    names = threadNames()
+    return dict((names.get(ident, ident), frameName(frame))
+                for ident, frame in sys._current_frames().items())
+
+
+class SamplingProfiler(object):
+    def __init__(self, log, directory=PROFILE_DIR, interval=SAMPLE_INTERVAL, duration=SAMPLE_DURATION):
+        self.Log = log
+        self.Directory = os.path.expanduser(directory)
+        self.Interval = interval
+        self.Duration = duration
+        self.Thread = None
+
+    def install(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self.handleSignal)
+
+    def handleSignal(self, signum, frame):
+        # Signal handlers run on the main thread between bytecodes, so only
+        # start the sampler here
+        if self.Thread is not None and self.Thread.is_alive():
+            return
+        self.Thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.Thread.start()
+
+    def sample(self):
+        '''
+        Returns {collapsed stack: samples}
+        '''
+        stacks = {}
+        own = threading.get_ident()
+        end = time.time() + self.Duration
+        while time.time() < end:
+            names = threadNames()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = "%s;%s" % (names.get(ident, ident), collapse(frame))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            time.sleep(self.Interval)
+        return stacks
+
+    def run(self):
+        self.Log.info("Profiling all threads for %ds" % self.Duration)
+        try:
+            stacks = self.sample()
+            path = os.path.join(self.Directory, "irrigation-profile-%s.folded" % time.strftime('%Y%m%d-%H%M%S'))
+            with open(path, "w") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write("%s %d\n" % (stack, count))
+            self.Log.info("Wrote %d stacks to %s" % (len(stacks), path))
+        except Exception as e:
+            self.Log.error("Profiling failed: %s" % (e), exc_info=1)
@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+'''
+Serial session recording and replay.
+
+A recording keeps every write to and line read from the Arduino with the time
+it happened, so a session captured on the real hardware (including whatever
+went wrong in it) can be fed back through control.Arduino later without any
+hardware attached. control.Arduino picks these up from the environment:
+
+    SERIAL_RECORD=session.rec python3 gui.py         # record a session
+    SERIAL_REPLAY=session.rec python3 gui.py         # replay it
+    SERIAL_REPLAY_SPEED=10 ...                       # 10x faster, 0 for no waiting
+
+    python3 recording.py session.rec                 # show a recording
+'''
+
+import logging
+import struct
+import sys
+import time
+
+
+MAGIC = b"IRSR\x01"
+# ms since the recording started, record kind, data length
+RECORD = struct.Struct("<IcH")
+OPENED = b'o'
+WRITE = b'w'
+READ = b'r'
+
+
+class Recorder(object):
+    '''
+    Appends records to the recording file. Each record is flushed as it is
+    written so a crash still leaves a usable recording.
+    '''
+    def __init__(self, path):
+        self.Path = path
+        self.File = open(path, "wb")
+        self.File.write(MAGIC)
+        self.Start = time.time()
+
+    def record(self, kind, data=b''):
+        ms = int((time.time() - self.Start)*1000)
+        self.File.write(RECORD.pack(ms, kind, len(data)) + data)
+        self.File.flush()
+
+
+class RecordingSerial(object):
+    '''
+    Wraps a serial stream and records the traffic through it
+    '''
+    def __init__(self, stream, recorder):
+        self.Stream = stream
+        self.Recorder = recorder
+        self.Recorder.record(OPENED)
+
+    def write(self, value):
+        self.Recorder.record(WRITE, value)
+        return self.Stream.write(value)
+
+    def readline(self):
+        line = self.Stream.readline()
+        self.Recorder.record(READ, line)
+        return line
+
+    def close(self):
+        self.Stream.close()
+
+
+def load(path):
+    '''
+    Returns [(ms, kind, data), ...]
+    '''
+    with open(path, "rb") as f:
+        contents = f.read()
+    if not contents.startswith(MAGIC):
+        raise ValueError("%s is not a serial recording" % path)
+
+    records = []
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(contents):
+        ms, kind, length = RECORD.unpack_from(contents, offset)
+        offset += RECORD.size
+        # A crash can leave the last record short
+        if offset + length > len(contents):
+            break
+        records.append((ms, kind, contents[offset:offset+length]))
+        offset += length
+    return records
+
+
+class ReplaySerial(object):
+    '''
+    Plays a recording back in place of the serial port. Lines are returned
+    in the order they were read, no sooner than they originally arrived
+    (scaled by speed, 0 returns them straight away). Writes are checked
+    against the recorded ones so a replay that no longer matches what the
+    host sends is reported. Once the recording runs out every read times
+    out like a silent Arduino would.
+    '''
+    def __init__(self, log, path, speed=1.0):
+        self.Log = log
+        self.Path = path
+        self.Speed = speed
+        records = load(path)
+        self.Writes = [data for ms, kind, data in records if kind == WRITE]
+        self.Reads = [(ms, data) for ms, kind, data in records if kind == READ]
+        self.WriteIndex = 0
+        self.ReadIndex = 0
+        self.Mismatches = 0
+        self.Finished = False
+        self.Start = time.time()
+        self.Log.info("Replaying %d writes and %d reads from %s" %
+                      (len(self.Writes), len(self.Reads), path))
+
+    def write(self, value):
+        if self.WriteIndex < len(self.Writes):
+            expected = self.Writes[self.WriteIndex]
+            self.WriteIndex += 1
+            if value != expected:
+                self.Mismatches += 1
+                self.Log.warning("Replay write %d: sent %s, recorded %s" %
+                                 (self.WriteIndex, value, expected))
+        return len(value)
+
+    def readline(self):
+        if self.ReadIndex >= len(self.Reads):
+            if not self.Finished:
+                self.Log.info("Replay of %s finished" % self.Path)
+                self.Finished = True
+            return b''
+
+        ms, line = self.Reads[self.ReadIndex]
+        self.ReadIndex += 1
+        if self.Speed > 0:
+            delay = self.Start + ms/1000.0/self.Speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return line
+
+    def close(self):
+        # Kept open across resets so the replay carries on where it was
+        pass
+
+
+if __name__ == "__main__":
+    log = logging.getLogger('RecordingLogger')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    for ms, kind, data in load(sys.argv[1]):
+        log.info("%10.3f %s %r" % (ms/1000.0, kind.decode(), data))
@@ -1,9 +1,14 @@
 #include <Arduino.h>
+#include <EEPROM.h>
 
 // The temperature sensor is a 1-wire automotive thermistor that is wired as
 // part of a voltage divider so that the ADC can be used to read a voltage
 //NOTE: A6 & A7 are analog only pins, so A7 is used for the ADC input
 #define TEMP_ADC_PIN                A7
+// Optional thermistors of the same type on the hot and cold supplies, so the
+// host can work out the mix before the mixed water changes
+#define HOT_SUPPLY_ADC_PIN          A6
+#define COLD_SUPPLY_ADC_PIN         A1
 
 // This controls an AC relay for running the recirculation pump
 // NOTE: due to the attached LED D13 is really only useful as an output
@@ -39,15 +44,120 @@
 #define VALVE_INCREMENTS            10
 // The docs on these valves say 6 to 8 seconds for full movement
 // But when pulsing, the momentum carries the valve a little further
-#define VALVE_PULSE_DELAY           4*1000/VALVE_INCREMENTS
+#define VALVE_TRAVEL_MS             4*1000
+#define VALVE_PULSE_DELAY           VALVE_TRAVEL_MS/VALVE_INCREMENTS
+// Give up on reaching a limit switch after this long
+#define VALVE_TIMEOUT_MS            15*1000
+// Valve travel times measured by 'K' are kept in the EEPROM
+#define SETTINGS_ADDRESS            0
+#define SETTINGS_MAGIC              0x4943
+// Valve positions change with nearly every move, which would soon wear out
+// the EEPROM, so they are kept in RAM that isn't cleared on reset instead
+#define RETAINED_MAGIC              0x5650
+
+// The thermistor calibration is a table of temperatures (tenths of a degree F)
+// at evenly spaced ADC values. Readings are linearly interpolated between
+// entries so a conversion is a single lookup. The table is uploaded by the host
+// with 'L' and kept in the EEPROM.
+#define ADC_MAX                     1024
+#define TEMP_TABLE_SHIFT            5
+#define TEMP_TABLE_STEP             (1 << TEMP_TABLE_SHIFT)
+#define TEMP_TABLE_SIZE             (ADC_MAX / TEMP_TABLE_STEP + 1)
+#define TEMP_TABLE_ADDRESS          16
+#define TEMP_TABLE_MAGIC            0x5454
+// Limits for the pulse length the host is allowed to set with 'S'
+#define MIN_PULSE_DELAY             50
+#define MAX_PULSE_DELAY             2000
+// Mixed, hot supply and cold supply
+#define TEMP_SENSORS                3
+// An average ADC reading outside of this range is an open or shorted sensor,
+// ie one that isn't fitted
+#define SENSOR_ADC_MIN              4
+#define SENSOR_ADC_MAX              1019
+// Commands with arguments (L, M, S and X) are collected up to their newline
+// as the bytes arrive, so the loop never waits on the serial line. A command
+// that isn't finished within ARGS_TIMEOUT_MS is dropped.
+#define ARGS_SIZE                   32
+#define ARGS_TIMEOUT_MS             250
+
+// Mixing valve motion states. Nothing blocks while a valve moves, the motors
+// are started and then checked on every pass of the loop, so both valves can
+// move at once and serial commands are still answered.
+#define VALVE_IDLE                  0
+#define VALVE_MOVING                1
+// Calibration runs to closed, then times a full open and a full close
+#define VALVE_CALIBRATE_HOME        2
+#define VALVE_CALIBRATE_OPEN        3
+#define VALVE_CALIBRATE_CLOSE       4
+
+
+// Positions and travel are in ms of motor run time from fully closed
+struct MixingValve {
+    uint8_t outA;
+    uint8_t outB;
+    uint8_t closedInput;
+    uint8_t openedInput;
+    uint16_t position;
+    uint16_t travel;
+    // The move in progress, position is updated once it stops
+    uint8_t state;
+    bool opening;
+    uint32_t started;
+    uint32_t duration;
+    // ms (negative to close) that was asked for when the move started
+    int32_t request;
+    // Time taken to open during calibration
+    uint32_t opened;
+};
+
+struct Settings {
+    uint16_t magic;
+    uint16_t coldTravel;
+    uint16_t hotTravel;
+};
+
+// Valve positions kept through a reset, ie the one the host causes when it
+// opens the serial port. check tells them apart from what is in the RAM
+// after a power up.
+struct RetainedPositions {
+    uint16_t magic;
+    uint16_t cold;
+    uint16_t hot;
+    uint16_t check;
+};
 
 
 //  Globals
 float TEMPERATURE = 0.0;
-uint8_t COLD_POSITION = 0;
-uint8_t HOT_POSITION = 0;
+MixingValve COLD_VALVE = {COLD_MIX_OUT_A, COLD_MIX_OUT_B, COLD_MIX_CLOSED_INPUT, COLD_MIX_OPENED_INPUT, 0, VALVE_TRAVEL_MS, VALVE_IDLE, false, 0, 0, 0, 0};
+MixingValve HOT_VALVE = {HOT_MIX_OUT_A, HOT_MIX_OUT_B, HOT_MIX_CLOSED_INPUT, HOT_MIX_OPENED_INPUT, 0, VALVE_TRAVEL_MS, VALVE_IDLE, false, 0, 0, 0, 0};
+bool CALIBRATING = false;
+RetainedPositions RETAINED __attribute__ ((section (".noinit")));
 char OUTPUT_POSITION = 'o';
 char RECIRCULATION_POSITION = 'r';
+uint16_t PULSE_DELAY = VALVE_PULSE_DELAY;
+float RAW_TEMPERATURE = 0.0;
+int16_t TEMP_TABLE[TEMP_TABLE_SIZE];
+const uint8_t TEMP_ADC_PINS[TEMP_SENSORS] = {TEMP_ADC_PIN, HOT_SUPPLY_ADC_PIN, COLD_SUPPLY_ADC_PIN};
+float TEMPERATURES[TEMP_SENSORS];
+bool SENSOR_FITTED[TEMP_SENSORS];
+// ADC readings taken so far towards the next averages
+uint32_t ADC_SUMS[TEMP_SENSORS];
+uint8_t ADC_COUNT = 0;
+// Safety interlock set by the host with 'X'. Limits are in tenths of a
+// degree F. The watchdog shuts the water off if no command has arrived for
+// WATCHDOG_MS (0 to disable).
+bool INTERLOCK = false;
+int16_t INTERLOCK_LOW = 0;
+int16_t INTERLOCK_HIGH = 0;
+uint32_t WATCHDOG_MS = 0;
+uint32_t LAST_COMMAND = 0;
+bool WATCHDOG_TRIPPED = false;
+// A command waiting on the rest of its arguments
+char PENDING_CODE = 0;
+char ARGS[ARGS_SIZE + 1];
+uint8_t ARGS_LENGTH = 0;
+uint32_t ARGS_STARTED = 0;
 
 
 void debug(String msg)
@@ -57,106 +167,337 @@ void debug(String msg)
 }
 
 
+long nextArg(const char *&args) {
+    // Like Serial.parseInt(), but from the argument buffer: skips to the
+    // next number and returns it (0 if there isn't one)
+    while (*args != '\0' && *args != '-' && !isdigit(*args)) {
+        args++;
+    }
+    char *end;
+    long value = strtol(args, &end, 10);
+    args = (end == args && *args != '\0') ? args + 1 : end;
+    return value;
+}
+
+
 float mapf(float x, float in_min, float in_max, float out_min, float out_max)
 {
   return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min;
 }
 
-float convertToFahrenheit(float value) {
-    // FIXME: Implement conversion function or lookup table
+float linearFahrenheit(float value) {
+    // Rough two point calibration used until a table is uploaded
     // 130F = 48
     // 44F = 280
-
-    // If linear 87F == 164
     return mapf(value, 280.0, 48.0, 44.0, 130.0);
 }
 
-void readTemperature() {
-    uint32_t sum = 0;
-    float value = 0;
-    for (uint8_t x=0; x< ANALOG_READS; x++) {
-        sum = sum + analogRead(TEMP_ADC_PIN);
+void defaultTemperatureTable() {
+    for (uint8_t x = 0; x < TEMP_TABLE_SIZE; x++) {
+        TEMP_TABLE[x] = linearFahrenheit(x * TEMP_TABLE_STEP) * 10;
     }
+}
 
-    value = sum / ANALOG_READS;
-    TEMPERATURE = convertToFahrenheit(value);
+void loadTemperatureTable() {
+    uint16_t magic;
+    EEPROM.get(TEMP_TABLE_ADDRESS, magic);
+    if (magic == TEMP_TABLE_MAGIC) {
+        EEPROM.get(TEMP_TABLE_ADDRESS + sizeof(magic), TEMP_TABLE);
+    } else {
+        defaultTemperatureTable();
+    }
 }
 
+void saveTemperatureTable() {
+    uint16_t magic = TEMP_TABLE_MAGIC;
+    EEPROM.put(TEMP_TABLE_ADDRESS, magic);
+    EEPROM.put(TEMP_TABLE_ADDRESS + sizeof(magic), TEMP_TABLE);
+}
+
+void clearTemperatureTable() {
+    uint16_t magic = 0;
+    EEPROM.put(TEMP_TABLE_ADDRESS, magic);
+    defaultTemperatureTable();
+}
 
-void pulseColdOpen() {
-    if (COLD_POSITION == VALVE_INCREMENTS) {
+void loadTableEntry(const char *args) {
+    // Expects "<index>,<tenths of a degree F>\n", ie "L12,725\n". The table
+    // is saved once the last entry has been received.
+    long index = nextArg(args);
+    long value = nextArg(args);
+    if (index < 0 || index >= TEMP_TABLE_SIZE) {
         return;
     }
-    COLD_POSITION++;
+    TEMP_TABLE[index] = value;
+    if (index == TEMP_TABLE_SIZE - 1) {
+        saveTemperatureTable();
+    }
+}
+
+float convertToFahrenheit(uint32_t sum) {
+    // sum is ANALOG_READS samples added together, which keeps the fraction
+    // between ADC steps for the interpolation
+    uint32_t step = (uint32_t)ANALOG_READS * TEMP_TABLE_STEP;
+    uint8_t index = sum / step;
+    if (index >= TEMP_TABLE_SIZE - 1) {
+        return TEMP_TABLE[TEMP_TABLE_SIZE - 1] / 10.0;
+    }
+    float fraction = (float)(sum % step) / step;
+    int16_t low = TEMP_TABLE[index];
+    int16_t high = TEMP_TABLE[index + 1];
+    return (low + (high - low) * fraction) / 10.0;
+}
 
-    do {
-        digitalWrite(COLD_MIX_OUT_A, HIGH);
-        digitalWrite(COLD_MIX_OUT_B, LOW);
+// Defined with the other safety code below
+void checkInterlock();
 
-        delay(VALVE_PULSE_DELAY);
+void sampleTemperature() {
+    // One sweep of the sensors per pass of the loop. The averages are
+    // updated every ANALOG_READS sweeps, so 'T' and 'A' never wait on the ADC.
+    for (uint8_t x = 0; x < TEMP_SENSORS; x++) {
+        ADC_SUMS[x] = ADC_SUMS[x] + analogRead(TEMP_ADC_PINS[x]);
+    }
+    ADC_COUNT++;
+    if (ADC_COUNT < ANALOG_READS) {
+        return;
+    }
 
-        digitalWrite(COLD_MIX_OUT_A, LOW);
-        digitalWrite(COLD_MIX_OUT_B, LOW);
+    RAW_TEMPERATURE = (float)ADC_SUMS[0] / ANALOG_READS;
+    for (uint8_t x = 0; x < TEMP_SENSORS; x++) {
+        uint32_t average = ADC_SUMS[x] / ANALOG_READS;
+        SENSOR_FITTED[x] = average >= SENSOR_ADC_MIN && average <= SENSOR_ADC_MAX;
+        TEMPERATURES[x] = convertToFahrenheit(ADC_SUMS[x]);
+        ADC_SUMS[x] = 0;
     }
-    while(digitalRead(COLD_MIX_OPENED_INPUT) == HIGH && COLD_POSITION == VALVE_INCREMENTS);
+    TEMPERATURE = TEMPERATURES[0];
+    ADC_COUNT = 0;
+    checkInterlock();
 }
 
-void pulseColdClosed() {
-    if (COLD_POSITION == 0) {
-        return;
+void printTemperatures() {
+    // Mixed, hot supply and cold supply, ie "72.50,118.20,51.30". Supply
+    // sensors that aren't fitted are left empty, ie "72.50,,"
+    Serial.print(TEMPERATURES[0]);
+    for (uint8_t x = 1; x < TEMP_SENSORS; x++) {
+        Serial.print(',');
+        if (SENSOR_FITTED[x]) {
+            Serial.print(TEMPERATURES[x]);
+        }
     }
+    Serial.println();
+}
+
+
+bool valveAtLimit(MixingValve &valve, bool open) {
+    // The limit switches are normally open with a pullup
+    return digitalRead(open ? valve.openedInput : valve.closedInput) == LOW;
+}
+
+void driveValve(MixingValve &valve, bool open) {
+    digitalWrite(valve.outA, open ? HIGH : LOW);
+    digitalWrite(valve.outB, open ? LOW : HIGH);
+}
 
-    COLD_POSITION--;
+void stopValve(MixingValve &valve) {
+    digitalWrite(valve.outA, LOW);
+    digitalWrite(valve.outB, LOW);
+}
 
-    do { 
-        digitalWrite(COLD_MIX_OUT_A, LOW);
-        digitalWrite(COLD_MIX_OUT_B, HIGH);
+uint16_t travelled(MixingValve &valve, uint32_t elapsed) {
+    // Where the valve is after running for elapsed ms of the current move
+    if (valve.opening) {
+        return min((uint32_t)valve.position + elapsed, (uint32_t)valve.travel);
+    }
+    return elapsed > valve.position ? 0 : valve.position - elapsed;
+}
 
-        delay(VALVE_PULSE_DELAY);
+uint16_t currentPosition(MixingValve &valve) {
+    if (valve.state == VALVE_IDLE) {
+        return valve.position;
+    }
+    return travelled(valve, millis() - valve.started);
+}
 
-        digitalWrite(COLD_MIX_OUT_A, LOW);
-        digitalWrite(COLD_MIX_OUT_B, LOW);
+void startValve(MixingValve &valve, bool open, uint32_t duration) {
+    valve.opening = open;
+    valve.started = millis();
+    valve.duration = duration;
+    driveValve(valve, open);
+}
 
+uint32_t haltValve(MixingValve &valve) {
+    // Stop the motor and account for how far it ran. Returns how long the
+    // motor ran for.
+    stopValve(valve);
+    uint32_t elapsed = millis() - valve.started;
+    if (valveAtLimit(valve, valve.opening)) {
+        valve.position = valve.opening ? valve.travel : 0;
+    } else {
+        valve.position = travelled(valve, elapsed);
     }
-    while(digitalRead(COLD_MIX_CLOSED_INPUT) == HIGH && COLD_POSITION == 0);
+    return elapsed;
 }
 
-void pulseHotOpen() {
-    if (HOT_POSITION == VALVE_INCREMENTS) {
+void moveValve(MixingValve &valve, int16_t ms, bool combine) {
+    // Start the valve motor for ms (negative to close) from where the valve
+    // is now. If it is still moving, a pulse (combine) is added to what is
+    // left of the current move, otherwise the current move is replaced, as
+    // the host works out timed moves from the live position 'V' reports.
+    // A move that would reach the end of travel keeps going until the limit
+    // switch so that the position gets re-calibrated.
+    if (valve.state != VALVE_IDLE && valve.state != VALVE_MOVING) {
+        // Calibrating
         return;
     }
 
-    HOT_POSITION++;
+    int32_t total = ms;
+    if (valve.state == VALVE_MOVING) {
+        uint32_t elapsed = haltValve(valve);
+        if (combine) {
+            int32_t remaining = valve.request - (valve.opening ? (int32_t)elapsed : -(int32_t)elapsed);
+            if ((remaining > 0) != valve.opening) {
+                remaining = 0;
+            }
+            total += remaining;
+        }
+        valve.state = VALVE_IDLE;
+    }
+
+    bool open = total > 0;
+    if (total == 0 || valveAtLimit(valve, open)) {
+        return;
+    }
 
-    do {
-        digitalWrite(HOT_MIX_OUT_A, HIGH);
-        digitalWrite(HOT_MIX_OUT_B, LOW);
+    int32_t target = (int32_t)valve.position + total;
+    uint32_t duration = abs(total);
+    if (target <= 0 || target >= valve.travel) {
+        duration = VALVE_TIMEOUT_MS;
+    }
 
-        delay(VALVE_PULSE_DELAY);
+    valve.request = total;
+    valve.state = VALVE_MOVING;
+    startValve(valve, open, duration);
+}
 
-        digitalWrite(HOT_MIX_OUT_A, LOW);
-        digitalWrite(HOT_MIX_OUT_B, LOW);
+void calibrateValve(MixingValve &valve) {
+    // Time a full close to open to close cycle between the limit switches.
+    // serviceValve() takes it through the steps.
+    if (valve.state != VALVE_IDLE) {
+        haltValve(valve);
     }
-    while(digitalRead(HOT_MIX_OPENED_INPUT) == HIGH && HOT_POSITION == VALVE_INCREMENTS);
+    valve.state = VALVE_CALIBRATE_HOME;
+    startValve(valve, false, VALVE_TIMEOUT_MS);
 }
 
-void pulseHotClosed() {
-    if (HOT_POSITION == 0) {
+void serviceValve(MixingValve &valve) {
+    // Stop the motor once the move is done and start the next calibration
+    // step if there is one
+    if (valve.state == VALVE_IDLE) {
+        return;
+    }
+    if (!valveAtLimit(valve, valve.opening) && millis() - valve.started < valve.duration) {
         return;
     }
 
-    HOT_POSITION--;
+    uint32_t elapsed = haltValve(valve);
+    switch (valve.state) {
+        case VALVE_CALIBRATE_HOME:
+            valve.state = VALVE_CALIBRATE_OPEN;
+            startValve(valve, true, VALVE_TIMEOUT_MS);
+            break;
+
+        case VALVE_CALIBRATE_OPEN:
+            valve.opened = elapsed;
+            valve.state = VALVE_CALIBRATE_CLOSE;
+            startValve(valve, false, VALVE_TIMEOUT_MS);
+            break;
+
+        case VALVE_CALIBRATE_CLOSE:
+            valve.travel = (valve.opened + elapsed) / 2;
+            valve.position = 0;
+            valve.state = VALVE_IDLE;
+            break;
+
+        default:
+            valve.state = VALVE_IDLE;
+            break;
+    }
+}
 
-    do {
-        digitalWrite(HOT_MIX_OUT_A, LOW);
-        digitalWrite(HOT_MIX_OUT_B, HIGH);
+void loadSettings() {
+    Settings settings;
+    EEPROM.get(SETTINGS_ADDRESS, settings);
+    if (settings.magic == SETTINGS_MAGIC) {
+        COLD_VALVE.travel = settings.coldTravel;
+        HOT_VALVE.travel = settings.hotTravel;
+    }
+}
 
-        delay(VALVE_PULSE_DELAY);
+void saveSettings() {
+    Settings settings = {SETTINGS_MAGIC, COLD_VALVE.travel, HOT_VALVE.travel};
+    EEPROM.put(SETTINGS_ADDRESS, settings);
+}
+
+uint16_t retainedCheck() {
+    return RETAINED.magic ^ RETAINED.cold ^ RETAINED.hot ^ 0xFFFF;
+}
 
-        digitalWrite(HOT_MIX_OUT_A, LOW);
-        digitalWrite(HOT_MIX_OUT_B, LOW);
+void retainPositions() {
+    // Called on every pass of the loop so a move in progress is tracked too.
+    // Positions are meaningless while calibrating.
+    if (CALIBRATING) {
+        RETAINED.magic = 0;
+        return;
+    }
+    RETAINED.magic = RETAINED_MAGIC;
+    RETAINED.cold = currentPosition(COLD_VALVE);
+    RETAINED.hot = currentPosition(HOT_VALVE);
+    RETAINED.check = retainedCheck();
+}
+
+void restorePositions() {
+    if (RETAINED.magic != RETAINED_MAGIC || RETAINED.check != retainedCheck()) {
+        return;
+    }
+    if (RETAINED.cold <= COLD_VALVE.travel) {
+        COLD_VALVE.position = RETAINED.cold;
+    }
+    if (RETAINED.hot <= HOT_VALVE.travel) {
+        HOT_VALVE.position = RETAINED.hot;
+    }
+}
+
+void calibrateValves() {
+    // Both valves are calibrated at the same time, 'K' is sent once they
+    // have both finished
+    calibrateValve(COLD_VALVE);
+    calibrateValve(HOT_VALVE);
+    CALIBRATING = true;
+}
+
+void serviceCalibration() {
+    if (!CALIBRATING || COLD_VALVE.state != VALVE_IDLE || HOT_VALVE.state != VALVE_IDLE) {
+        return;
+    }
+    CALIBRATING = false;
+    saveSettings();
+    Serial.println('K');
+}
+
+void moveCommand(const char *args) {
+    // Expects the valve, then the run time in ms (negative to close)
+    // terminated by a newline, ie "Mc-250\n"
+    char valve = args[0];
+    if (valve != '\0') {
+        args++;
+    }
+    long ms = nextArg(args);
+    ms = constrain(ms, -VALVE_TIMEOUT_MS, VALVE_TIMEOUT_MS);
+    if (valve == 'c') {
+        moveValve(COLD_VALVE, ms, false);
+    } else if (valve == 'h') {
+        moveValve(HOT_VALVE, ms, false);
     }
-    while(digitalRead(HOT_MIX_CLOSED_INPUT) == HIGH && HOT_POSITION == 0);
 }
 
 void openOutput() {
@@ -187,36 +528,101 @@ void closeRecirculation() {
     RECIRCULATION_POSITION = 'r';
 }
 
-void updateValvePositions() {
-    // COLD Water Valve
-    if (digitalRead(COLD_MIX_CLOSED_INPUT) == LOW) {
-        COLD_POSITION = 0;
-    } else if (digitalRead(COLD_MIX_OPENED_INPUT) == LOW) {
-        COLD_POSITION = VALVE_INCREMENTS;
+void setInterlock(const char *args) {
+    // Expects "<low>,<high>,<watchdog>\n" with the limits in tenths of a
+    // degree F and the watchdog in seconds, ie "X680,760,30\n"
+    INTERLOCK_LOW = nextArg(args);
+    INTERLOCK_HIGH = nextArg(args);
+    WATCHDOG_MS = (uint32_t)nextArg(args) * SEC_TO_MS;
+    INTERLOCK = true;
+}
+
+void checkInterlock() {
+    // Out of band water must never reach the plants. Called with every new
+    // temperature reading, so it acts within a few ms without waiting for
+    // the host. Recirculation is opened before the output closes so the
+    // flow is never dead-headed.
+    if (!INTERLOCK || OUTPUT_POSITION != 'O') {
+        return;
+    }
+    int16_t tenths = TEMPERATURE * 10;
+    if (tenths >= INTERLOCK_LOW && tenths <= INTERLOCK_HIGH) {
+        return;
     }
+    openRecirculation();
+    startPump();
+    closeOutput();
+    Serial.print("!T");
+    Serial.println(tenths);
+}
 
-    // HOT Water Valve
-    if (digitalRead(HOT_MIX_CLOSED_INPUT) == LOW) {
-        HOT_POSITION = 0;
-    } else if (digitalRead(HOT_MIX_OPENED_INPUT) == LOW) {
-        HOT_POSITION = VALVE_INCREMENTS;
+void checkWatchdog() {
+    // The host has gone quiet, so nothing is watching the water. Shut it
+    // all off until the host is back.
+    if (!INTERLOCK || WATCHDOG_MS == 0 || WATCHDOG_TRIPPED) {
+        return;
     }
+    if (millis() - LAST_COMMAND < WATCHDOG_MS) {
+        return;
+    }
+    WATCHDOG_TRIPPED = true;
+    closeOutput();
+    stopPump();
+    closeRecirculation();
+    Serial.println("!W");
 }
 
-void printValves()
-{
-    for (uint8_t x=0; x<COLD_POSITION; x++) {
-        Serial.print('C');
+void setPulseDelay(const char *args) {
+    // Expects the pulse length in ms terminated by a newline, ie "S250\n"
+    long value = nextArg(args);
+    if (value < MIN_PULSE_DELAY) {
+        value = MIN_PULSE_DELAY;
+    } else if (value > MAX_PULSE_DELAY) {
+        value = MAX_PULSE_DELAY;
     }
-    for (uint8_t x = 0; x < HOT_POSITION; x++)
-    {
-        Serial.print('H');
+    PULSE_DELAY = value;
+}
+
+void updateValvePosition(MixingValve &valve) {
+    // Moving valves are taken care of by serviceValve()
+    if (valve.state != VALVE_IDLE) {
+        return;
     }
+    if (valveAtLimit(valve, false)) {
+        valve.position = 0;
+    } else if (valveAtLimit(valve, true)) {
+        valve.position = valve.travel;
+    }
+}
+
+void updateValvePositions() {
+    updateValvePosition(COLD_VALVE);
+    updateValvePosition(HOT_VALVE);
+}
+
+void printValves()
+{
+    // C<position>/<travel>H<position>/<travel> followed by the output and
+    // recirculation states and then whether each valve is on its closed
+    // limit switch, ie "C1200/4000H0/4100orL01"
+    Serial.print('C');
+    Serial.print(currentPosition(COLD_VALVE));
+    Serial.print('/');
+    Serial.print(COLD_VALVE.travel);
+    Serial.print('H');
+    Serial.print(currentPosition(HOT_VALVE));
+    Serial.print('/');
+    Serial.print(HOT_VALVE.travel);
 
     // FIXME: add valve status (when in transition)
     Serial.print(OUTPUT_POSITION);
     Serial.print(RECIRCULATION_POSITION);
 
+    // Which of the mixing valves are on their closed limit switch
+    Serial.print('L');
+    Serial.print(valveAtLimit(COLD_VALVE, false) ? '1' : '0');
+    Serial.print(valveAtLimit(HOT_VALVE, false) ? '1' : '0');
+
     Serial.println();
 }
 
@@ -258,93 +664,201 @@ void setup() {
     closeOutput();
 
     // Initialize Variables
-    readTemperature();
+    loadSettings();
+    restorePositions();
+    loadTemperatureTable();
+    for (uint8_t x = 0; x < ANALOG_READS; x++) {
+        sampleTemperature();
+    }
 
     debug("STARTUP Complete");
 }
 
-void loop() {
-    if (Serial.available() > 0) {
+void runCommand(char code) {
+    switch(code) {
+        case 'A':
+            // Raw (averaged) ADC reading of the thermistor for calibration
+            Serial.println(RAW_TEMPERATURE);
+            break;
+
+        case 'C':
+            // Pulse the cold valve a little more open
+            moveValve(COLD_VALVE, PULSE_DELAY, true);
+            Serial.println('C');
+            break;
+
+        case 'c':
+            // Pulse the cold valve a little more closed
+            moveValve(COLD_VALVE, -PULSE_DELAY, true);
+            Serial.println('c');
+            break;
+
+        case 'H':
+            // Pulse the hot valve a little more open
+            moveValve(HOT_VALVE, PULSE_DELAY, true);
+            Serial.println('H');
+            break;
+
+        case 'h':
+            // Pulse the hot valve a little more closed
+            moveValve(HOT_VALVE, -PULSE_DELAY, true);
+            Serial.println('h');
+            break;
+
+        case 'I':
+            Serial.println('I');
+            break;
+
+        case 'K':
+            // Calibrate the travel time of the mixing valves. 'K' is sent
+            // when it finishes
+            calibrateValves();
+            break;
+
+        case 'L':
+            // Load an entry of the thermistor calibration table
+            loadTableEntry(ARGS);
+            Serial.println('L');
+            break;
+
+        case 'l':
+            // Go back to the default thermistor calibration
+            clearTemperatureTable();
+            Serial.println('l');
+            break;
+
+        case 'M':
+            // Start a mixing valve motor for a number of ms
+            moveCommand(ARGS);
+            Serial.println('M');
+            break;
+
+        case 'O':
+            // Open the output valve
+            openOutput();
+            Serial.println('O');
+            break;
+
+        case 'o':
+            // Close the output valve
+            closeOutput();
+            Serial.println('o');
+            break;
+
+        case 'P':
+            // Turn on the pump
+            startPump();
+            Serial.println('P');
+            break;
+
+        case 'p':
+            // Turn off the pump
+            stopPump();
+            Serial.println('p');
+            break;
+
+        case 'R':
+            // Open the recirculation valve
+            openRecirculation();
+            Serial.println('R');
+            break;
+
+        case 'r':
+            // Close the recirculation valve
+            closeRecirculation();
+            Serial.println('r');
+            break;
+
+        case 'S':
+            // Set the length of a valve pulse
+            setPulseDelay(ARGS);
+            Serial.println('S');
+            break;
+
+        case 'T':
+            printTemperatures();
+            break;
+
+        case 'V':
+            printValves();
+            break;
+
+        case 'W':
+            // Heartbeat for when the host has nothing else to send
+            Serial.println('W');
+            break;
+
+        case 'X':
+            // Set the safety interlock limits and watchdog
+            setInterlock(ARGS);
+            Serial.println('X');
+            break;
+
+        case 'x':
+            // Turn the safety interlock off
+            INTERLOCK = false;
+            Serial.println('x');
+            break;
+
+        case '\n':
+        case '\r':
+            // Terminators left behind by commands with arguments
+            break;
+
+        default:
+            Serial.println('E');
+            break;
+    }
+}
+
+void readCommand() {
+    // Runs at most one command per pass of the loop. The arguments of a
+    // command are gathered over as many passes as they take to arrive.
+    if (PENDING_CODE != 0 && millis() - ARGS_STARTED > ARGS_TIMEOUT_MS) {
+        PENDING_CODE = 0;
+        Serial.println('E');
+    }
+    while (Serial.available() > 0) {
         char code = Serial.read();
-        switch(code) {
-            case 'C':
-                // Pulse the cold valve a little more open
-                pulseColdOpen();
-                Serial.println('C');
-                break;
-
-            case 'c':
-                // Pulse the cold valve a little more closed
-                pulseColdClosed();
-                Serial.println('c');
-                break;
-
-            case 'H':
-                // Pulse the hot valve a little more open
-                pulseHotOpen();
-                Serial.println('H');
-                break;
-
-            case 'h':
-                // Pulse the hot valve a little more closed
-                pulseHotClosed();
-                Serial.println('h');
-                break;
-
-            case 'I':
-                Serial.println('I');
-                break;
-
-            case 'O':
-                // Open the output valve
-                openOutput();
-                Serial.println('O');
-                break;
-
-            case 'o':
-                // Close the output valve
-                closeOutput();
-                Serial.println('o');
-                break;
-
-            case 'P':
-                // Turn on the pump
-                startPump();
-                Serial.println('P');
-                break;
-
-            case 'p':
-                // Turn off the pump
-                stopPump();
-                Serial.println('p');
-                break;
-
-            case 'R':
-                // Open the recirculation valve
-                openRecirculation();
-                Serial.println('R');
-                break;
-
-            case 'r':
-                // Close the recirculation valve
-                closeRecirculation();
-                Serial.println('r');
-                break;
-
-            case 'T':
-                readTemperature();
-                Serial.println(TEMPERATURE);
-                break;
-
-            case 'V':
-                printValves();
-                break;
-
-            default:
+        // Any command shows the host is alive
+        LAST_COMMAND = millis();
+        WATCHDOG_TRIPPED = false;
+
+        if (PENDING_CODE != 0) {
+            if (code != '\n' && code != '\r') {
+                if (ARGS_LENGTH < ARGS_SIZE) {
+                    ARGS[ARGS_LENGTH++] = code;
+                } else {
+                    // Too long to be a real command
+                    ARGS_LENGTH = ARGS_SIZE + 1;
+                }
+                continue;
+            }
+            code = PENDING_CODE;
+            PENDING_CODE = 0;
+            if (ARGS_LENGTH > ARGS_SIZE) {
                 Serial.println('E');
-                break;
+                return;
+            }
+            ARGS[ARGS_LENGTH] = '\0';
+        } else if (code == 'L' || code == 'M' || code == 'S' || code == 'X') {
+            PENDING_CODE = code;
+            ARGS_LENGTH = 0;
+            ARGS_STARTED = millis();
+            continue;
         }
+        runCommand(code);
+        return;
     }
+}
 
+void loop() {
+    readCommand();
+    serviceValve(COLD_VALVE);
+    serviceValve(HOT_VALVE);
+    serviceCalibration();
+    sampleTemperature();
+    checkWatchdog();
     updateValvePositions();
+    retainPositions();
 }
@@ -0,0 +1,135 @@
+from array import array
+
+
+class RollingWindow(object):
+    '''
+    Fixed size window of the most recent (time, value) samples.
+
+    The samples are kept in preallocated arrays used as a ring buffer, and the
+    running sums needed for the mean, variance and least squares slope are
+    updated as samples come and go, so every statistic is O(1).
+    '''
+    def __init__(self, size):
+        self.Size = size
+        self.Times = array('d', [0.0]*size)
+        self.Values = array('d', [0.0]*size)
+        # Index of the oldest sample
+        self.Start = 0
+        self.Length = 0
+        # Total number of samples ever added, useful to tell if it changed
+        self.Count = 0
+        # Times are offset by the first sample to keep the sums well scaled
+        self.Origin = None
+        self._resetSums()
+
+    def _resetSums(self):
+        self.SumT = 0.0
+        self.SumTT = 0.0
+        self.SumV = 0.0
+        self.SumVV = 0.0
+        self.SumTV = 0.0
+
+    def _add(self, t, v):
+        self.SumT += t
+        self.SumTT += t*t
+        self.SumV += v
+        self.SumVV += v*v
+        self.SumTV += t*v
+
+    def _remove(self, t, v):
+        self.SumT -= t
+        self.SumTT -= t*t
+        self.SumV -= v
+        self.SumVV -= v*v
+        self.SumTV -= t*v
+
+    def _recompute(self):
+        # Floating point error builds up in the running sums, so they are
+        # rebuilt from scratch once per trip around the buffer. The time
+        # origin moves up to the oldest sample at the same time so the time
+        # sums stay small.
+        shift = self.Times[self.Start]
+        self.Origin += shift
+        self._resetSums()
+        for x in range(self.Length):
+            index = (self.Start + x) % self.Size
+            self.Times[index] -= shift
+            self._add(self.Times[index], self.Values[index])
+
+    def append(self, t, v):
+        if self.Origin is None:
+            self.Origin = t
+        t = t - self.Origin
+
+        if self.Length == self.Size:
+            self._remove(self.Times[self.Start], self.Values[self.Start])
+            index = self.Start
+            self.Start = (self.Start + 1) % self.Size
+        else:
+            index = (self.Start + self.Length) % self.Size
+            self.Length += 1
+
+        self.Times[index] = t
+        self.Values[index] = v
+        self._add(t, v)
+        self.Count += 1
+        if self.Count % self.Size == 0:
+            self._recompute()
+
+    def clear(self):
+        self.Start = 0
+        self.Length = 0
+        self.Origin = None
+        self._resetSums()
+
+    def __len__(self):
+        return self.Length
+
+    def samples(self):
+        '''
+        Iterate (time, value) from oldest to newest
+        '''
+        for x in range(self.Length):
+            index = (self.Start + x) % self.Size
+            yield (self.Times[index] + self.Origin, self.Values[index])
+
+    def values(self):
+        for x in range(self.Length):
+            yield self.Values[(self.Start + x) % self.Size]
+
+    def last(self):
+        if self.Length == 0:
+            return None
+        return self.Values[(self.Start + self.Length - 1) % self.Size]
+
+    def mean(self):
+        if self.Length == 0:
+            return None
+        return self.SumV/self.Length
+
+    def variance(self):
+        if self.Length == 0:
+            return None
+        mean = self.SumV/self.Length
+        return max(self.SumVV/self.Length - mean*mean, 0.0)
+
+    def slope(self):
+        '''
+        Least squares slope of value against time (units per second)
+        '''
+        n = self.Length
+        if n < 2:
+            return 0.0
+        denominator = n*self.SumTT - self.SumT*self.SumT
+        if denominator <= 0:
+            return 0.0
+        return (n*self.SumTV - self.SumT*self.SumV)/denominator
+
+    def predict(self, t):
+        '''
+        Extrapolate the latest value along the trend to time t
+        '''
+        if self.Length == 0:
+            return None
+        last_time = self.Times[(self.Start + self.Length - 1) % self.Size] + self.Origin
+        return self.last() + self.slope()*(t - last_time)
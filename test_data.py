@@ -0,0 +1,182 @@
+'''
+Tests for the cached query layer in data.py, run against a local stand-in
+for the Influx HTTP server.
+
+    python3 -m unittest test_data
+'''
+
+import http.client
+import http.server
+import json
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+
+import data
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.Lock:
+            server.Requests += 1
+            count = server.Requests
+        time.sleep(server.Delay)
+        if server.Fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps({'value': count}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    '''
+    Answers every GET with {"value": <requests so far>}, after Delay
+    seconds, or with a 500 while Fail is set
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.Lock = threading.Lock()
+        self.Requests = 0
+        self.Delay = 0
+        self.Fail = False
+        self.Thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.Thread.start()
+
+    def query(self):
+        connection = http.client.HTTPConnection(*self.server_address, timeout=5)
+        try:
+            connection.request("GET", "/query")
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise Exception("HTTP %d" % response.status)
+            return json.loads(body)['value']
+        finally:
+            connection.close()
+
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.Server = StandInServer()
+        self.Log = logging.getLogger('QueryCacheTest')
+        self.Log.addHandler(logging.NullHandler())
+        self.Log.propagate = False
+        self.Cache = data.QueryCache(self.Log)
+
+    def tearDown(self):
+        self.Server.shutdown()
+        self.Server.server_close()
+
+    def add(self, ttl):
+        self.Cache.addQuery('test', self.Server.query, ttl)
+
+    def test_ttl_expiry(self):
+        self.add(0.3)
+        self.assertIsNone(self.Cache.getCached('test'))
+        self.Cache.prefetch()
+        self.assertEqual(self.Cache.getCached('test'), 1)
+        self.assertFalse(self.Cache.Wakeup.is_set())
+
+        time.sleep(0.35)
+        # Expired, so the data thread is asked for a refresh
+        self.assertEqual(self.Cache.getCached('test'), 1)
+        self.assertTrue(self.Cache.Wakeup.is_set())
+        self.assertEqual(self.Cache.nextPrefetch(), 0)
+        self.Cache.prefetch()
+        self.assertEqual(self.Cache.getCached('test'), 2)
+        self.assertEqual(self.Server.Requests, 2)
+
+    def test_prefetch_before_expiry(self):
+        self.add(0.5)
+        self.Cache.prefetch()
+        self.assertGreater(self.Cache.nextPrefetch(), 0.3)
+        time.sleep(0.5*data.PREFETCH_FRACTION + 0.05)
+        self.assertEqual(self.Cache.nextPrefetch(), 0)
+        self.Cache.prefetch()
+        self.assertEqual(self.Server.Requests, 2)
+
+    def test_stale_while_revalidate(self):
+        self.add(0.2)
+        self.Cache.prefetch()
+        time.sleep(0.25)
+        self.Server.Delay = 0.5
+        refresh = threading.Thread(target=self.Cache.prefetch)
+        refresh.start()
+        time.sleep(0.1)
+
+        # The stale value comes straight back while the refresh is in flight
+        start = time.time()
+        self.assertEqual(self.Cache.getCached('test'), 1)
+        self.assertLess(time.time() - start, 0.05)
+        # and the data thread isn't asked for another refresh
+        self.assertFalse(self.Cache.Wakeup.is_set())
+
+        refresh.join()
+        self.assertEqual(self.Cache.getCached('test'), 2)
+
+    def test_max_stale_cutoff(self):
+        with mock.patch.object(data, 'MAX_STALE_TTLS', 3):
+            self.add(0.1)
+            self.Cache.prefetch()
+            time.sleep(0.2)
+            self.assertEqual(self.Cache.getCached('test'), 1)
+            time.sleep(0.15)
+            self.assertIsNone(self.Cache.getCached('test'))
+
+    def test_retry_backoff(self):
+        with mock.patch.object(data, 'RETRY_DELAY', 0.5):
+            self.add(60)
+            self.Server.Fail = True
+            self.Cache.prefetch()
+            self.assertEqual(self.Server.Requests, 1)
+            self.assertIsNone(self.Cache.getCached('test'))
+            self.assertGreater(self.Cache.nextPrefetch(), 0.3)
+
+            # Asking again during the backoff neither wakes the data thread
+            # nor sends a query
+            self.Cache.Wakeup.clear()
+            for x in range(10):
+                self.assertIsNone(self.Cache.getCached('test'))
+            self.assertFalse(self.Cache.Wakeup.is_set())
+            self.Cache.prefetch()
+            self.assertEqual(self.Server.Requests, 1)
+
+            self.Server.Fail = False
+            time.sleep(0.55)
+            self.assertEqual(self.Cache.nextPrefetch(), 0)
+            self.Cache.prefetch()
+            self.assertEqual(self.Server.Requests, 2)
+            self.assertEqual(self.Cache.getCached('test'), 2)
+
+    def test_coalescing(self):
+        self.add(60)
+        self.Server.Delay = 0.3
+        results = []
+
+        def refresh():
+            results.append(self.Cache.refresh('test'))
+
+        threads = [threading.Thread(target=refresh) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.Server.Requests, 1)
+        self.assertEqual(results, [1]*5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,244 @@
+#! /usr/bin/env python3
+'''
+Auto-tuning for the temperature controller.
+
+Step tests are run through the recirculation loop (so no water reaches the
+plants) by pulsing the mixing valves and watching the temperature respond.
+From the response we measure the process gain, dead time and time constant,
+and from those pick a valve pulse size, controller gain, control interval
+and temperature band for this installation. The results are saved to
+TUNING_FILE and picked up by control.TempControl on the next start.
+'''
+
+import json
+import logging
+import math
+import os
+import time
+
+
+TUNING_FILE = os.path.expanduser("~/.irrigation-tuning.config")
+
+SAMPLE_INTERVAL = 1.0
+STEADY_SAMPLES = 10
+STEADY_SLOPE = 0.05
+STEADY_TIMEOUT = 5*60
+STEP_PULSES = 2
+
+# Wanted temperature change (F) for a single valve pulse
+TARGET_DEGREES_PER_PULSE = 1.0
+MIN_PULSE_DELAY = 50
+MAX_PULSE_DELAY = 2000
+# Fraction of the error corrected each control step. Less than one because
+# the result of a correction isn't visible until after the dead time.
+CONTROLLER_GAIN = 0.5
+
+
+def load(log, defaults):
+    '''
+    Return the saved tuning for this installation, falling back to defaults
+    for anything that hasn't been tuned.
+    '''
+    tuning = dict(defaults)
+    try:
+        with open(TUNING_FILE) as f:
+            tuning.update(json.load(f))
+        log.info("Loaded controller tuning from %s: %s" % (TUNING_FILE, tuning))
+    except FileNotFoundError:
+        log.info("No controller tuning at %s. Using defaults" % (TUNING_FILE))
+    except Exception as e:
+        log.error("Failed to read %s: %s" % (TUNING_FILE, e))
+    return tuning
+
+
+def save(tuning):
+    tmp_file = TUNING_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(tuning, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, TUNING_FILE)
+
+
+def mean(values):
+    return sum(values)/len(values)
+
+
+def isSteady(samples):
+    '''
+    samples are (time, temperature) tuples
+    '''
+    if len(samples) < STEADY_SAMPLES:
+        return False
+    window = samples[-STEADY_SAMPLES:]
+    slope = (window[-1][1] - window[0][1])/(window[-1][0] - window[0][0])
+    return abs(slope) < STEADY_SLOPE
+
+
+def stddev(values):
+    m = mean(values)
+    return math.sqrt(sum((v-m)**2 for v in values)/len(values))
+
+
+class AutoTuner(object):
+    def __init__(self, log, arduino, pulse_delay, start_position):
+        self.Log = log
+        self.Arduino = arduino
+        self.PulseDelay = pulse_delay
+        # Percent open for both valves at the start of the step tests
+        self.StartPosition = start_position
+        self.Noise = 0.0
+
+    def sample(self):
+        '''
+        (time, temperature), or None if the temperature couldn't be read
+        '''
+        time.sleep(SAMPLE_INTERVAL)
+        temperature = self.Arduino.getTemperature()
+        if temperature is None:
+            return None
+        return (time.time(), temperature)
+
+    def waitForSteady(self):
+        '''
+        Sample until the temperature stops moving. Returns the samples from
+        the last steady window.
+        '''
+        samples = []
+        start = time.time()
+        while time.time() - start < STEADY_TIMEOUT:
+            sample = self.sample()
+            if sample is None:
+                continue
+            samples.append(sample)
+            if isSteady(samples):
+                break
+        else:
+            self.Log.error("Temperature never settled. Using the last samples")
+        return samples[-STEADY_SAMPLES:]
+
+    def measureStep(self, name, pulse):
+        '''
+        Apply STEP_PULSES pulses and record the response until it settles.
+        Returns (degrees per pulse, dead time, time constant)
+        '''
+        baseline_samples = self.waitForSteady()
+        baseline = mean([t for _, t in baseline_samples])
+        self.Noise = max(self.Noise, stddev([t for _, t in baseline_samples]))
+        self.Log.info("%s step: baseline %.2f F, noise %.2f F" % (name, baseline, self.Noise))
+
+        start = time.time()
+        for x in range(STEP_PULSES):
+            pulse()
+
+        response = []
+        while time.time() - start < STEADY_TIMEOUT:
+            sample = self.sample()
+            if sample is None:
+                continue
+            response.append(sample)
+            if isSteady(response):
+                break
+
+        final = mean([t for _, t in response[-STEADY_SAMPLES:]])
+        delta = final - baseline
+        self.Log.info("%s step: final %.2f F, change %.2f F" % (name, final, delta))
+
+        dead_time = None
+        rise_time = None
+        threshold = max(3*self.Noise, 0.2)
+        for t, temp in response:
+            change = abs(temp - baseline)
+            if dead_time is None and change > threshold:
+                dead_time = t - start
+            if rise_time is None and change >= abs(delta)*0.63:
+                rise_time = t - start
+
+        if dead_time is None or rise_time is None:
+            self.Log.error("%s step: no response measured" % name)
+            return None
+
+        time_constant = max(rise_time - dead_time, SAMPLE_INTERVAL)
+        self.Log.info("%s step: %.2f F/pulse, dead time %.1fs, time constant %.1fs" %
+                      (name, delta/STEP_PULSES, dead_time, time_constant))
+        return (delta/STEP_PULSES, dead_time, time_constant)
+
+    def run(self):
+        '''
+        Run the step tests and return the computed tuning
+        '''
+        self.Log.info("Starting auto-tune")
+        self.Arduino.setPulseDelay(self.PulseDelay)
+        # Left over if the GUI didn't stop cleanly
+        self.Arduino.clearInterlock()
+        self.Arduino.closeOutput()
+        self.Arduino.openRecycle()
+        self.Arduino.startRecyclePump()
+        try:
+            if not self.Arduino.calibrateValves():
+                raise RuntimeError("Auto-tune failed: the mixing valves couldn't be calibrated")
+            # Start from the same valve positions TempControl starts a run from
+            valves = self.Arduino.getValveStates()
+            if valves is None:
+                raise RuntimeError("Auto-tune failed: the valve positions couldn't be read")
+            self.Arduino.moveCold((self.StartPosition - valves['cold'])*valves['cold_travel']/100)
+            self.Arduino.moveHot((self.StartPosition - valves['hot'])*valves['hot_travel']/100)
+
+            results = [
+                self.measureStep("Hot", self.Arduino.pulseOpenHot),
+                self.measureStep("Cold", self.Arduino.pulseOpenCold),
+            ]
+        finally:
+            self.Arduino.stopRecyclePump()
+            self.Arduino.closeRecycle()
+
+        results = [r for r in results if r is not None]
+        if not results:
+            raise RuntimeError("Auto-tune failed: the temperature didn't respond to the valves")
+        return self.compute(results)
+
+    def compute(self, results):
+        degrees_per_pulse = mean([abs(r[0]) for r in results])
+        dead_time = max([r[1] for r in results])
+        time_constant = max([r[2] for r in results])
+
+        # Scale the pulse so that one pulse makes a useful, but not too large
+        # change. Assumes the response is roughly linear in the pulse length.
+        pulse_delay = self.PulseDelay
+        if degrees_per_pulse > 0:
+            pulse_delay = self.PulseDelay*TARGET_DEGREES_PER_PULSE/degrees_per_pulse
+        pulse_delay = int(min(max(pulse_delay, MIN_PULSE_DELAY), MAX_PULSE_DELAY))
+        degrees_per_pulse = degrees_per_pulse*pulse_delay/self.PulseDelay
+
+        # Wait for the last correction to show up before making the next
+        update_delay = min(max(dead_time + time_constant/2, 1.0), 60.0)
+
+        # The band has to be wider than a single pulse can move the
+        # temperature and the sensor noise, otherwise it can never hold
+        temp_threshold = round(max(degrees_per_pulse, 4*self.Noise, 1.0), 1)
+
+        tuning = {
+            'pulse_delay': pulse_delay,
+            'update_delay': round(update_delay, 1),
+            'temp_threshold': temp_threshold,
+            'pulses_per_degree': round(CONTROLLER_GAIN/max(degrees_per_pulse, 0.01), 3),
+            'dead_time': round(dead_time, 1),
+            'time_constant': round(time_constant, 1),
+            'tuned': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self.Log.info("Auto-tune result: %s" % tuning)
+        return tuning
+
+
+if __name__ == "__main__":
+    # control imports this module
+    import control
+
+    log = logging.getLogger('TuningLogger')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+
+    arduino = control.Arduino(log)
+    tuning = load(log, control.DEFAULT_TUNING)
+    tuner = AutoTuner(log, arduino, tuning['pulse_delay'], control.START_POSITION)
+    tuning.update(tuner.run())
+    save(tuning)
+    log.info("Saved tuning to %s" % TUNING_FILE)
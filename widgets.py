@@ -41,13 +41,6 @@ class ImageButton(object):
 
         surface.blit(self.Image, self.Position)
 
-    def handleClick(self, event_pos):
-        # print("Rect: %s, pos: %s"%(self.Rect, event_pos))
-        if self.Rect.collidepoint(event_pos):
-            self.callback()
-            return True
-        return False
-
     def callback(self):
         self.Handler()
 
@@ -157,15 +150,28 @@ class StartStopButton(object):
         surface.blit(base_surface, (rect[0], rect[1]))
         self.Rectangle = pygame.Rect(*rect)
 
-    def handleClick(self, event_pos):
-        # print("Rect: %s, pos: %s"%(self.Rectangle, event_pos))
-        if self.Rectangle.collidepoint(event_pos):
-            if self.On:
-                self.On = False
-                self.StopCallback()
+    def hitRect(self):
+        '''
+        Area that covers the button in both states, the two labels aren't
+        the same size
+        '''
+        rect = None
+        for text in (self.StartText, self.StopText):
+            size = self.Font.size(text)
+            if self.Center:
+                r = pygame.Rect(self.Position[0] - size[0]/2, self.Position[1] - size[1]/2, size[0], size[1])
             else:
-                self.On = True
-                self.StartCallback()
+                r = pygame.Rect(self.Position[0], self.Position[1], size[0], size[1])
+            rect = r if rect is None else rect.union(r)
+        return rect
+
+    def toggle(self):
+        if self.On:
+            self.On = False
+            self.StopCallback()
+        else:
+            self.On = True
+            self.StartCallback()
 
 
 class OpenCloseButton(StartStopButton):
@@ -192,6 +198,11 @@ class TimerControl(object):
         self.Running = False
         self.StopHandler()
 
+    def resume(self, start_time):
+        # Pick up a run that was started before a restart
+        self.StartTime = start_time
+        self.Running = True
+
     def render(self, surface):
         if self.Running:
             elapsed = time.time() - self.StartTime
@@ -227,15 +238,12 @@ class MixingValveStatus(object):
         self.Size = size
         self.GetValvePercent = valve_percent_handler
         self.Center = center
-        self.LastTime = time.time()
         self.Percent = 0
 
     def render(self, surface):
-        # Valve Status
-        now = time.time()
-        if now - self.LastTime > 3:
-            self.Percent = self.GetValvePercent()
-            self.LastTime = now
+        # Valve Status. The handler returns a cached position, so it is
+        # cheap enough to call every frame.
+        self.Percent = self.GetValvePercent()
 
         if self.Percent > 0:
             width = int(self.Size[0] * (self.Percent/100))
@@ -245,3 +253,148 @@ class MixingValveStatus(object):
             rect = (self.Position[0], self.Position[1], self.Size[0], self.Size[1])
             pygame.draw.rect(surface, RED, rect)
 
+
+
+class Sparkline(object):
+    '''
+    Small line plot of a stats.RollingWindow. The plot is only redrawn when
+    a new sample has been added to the window.
+    '''
+    def __init__(self, position, size, window, value_range, color=BLACK):
+        self.Position = position
+        self.Size = size
+        self.Window = window
+        self.Range = value_range
+        self.Color = color
+        self.Surface = pygame.surface.Surface(self.Size, pygame.SRCALPHA)
+        self.DrawnCount = None
+
+    def draw(self):
+        self.Surface.fill((0, 0, 0, 0))
+        pygame.draw.rect(self.Surface, GREY, (0, 0, self.Size[0], self.Size[1]), 1)
+
+        length = len(self.Window)
+        if length < 2:
+            return
+        low, high = self.Range
+        x_scale = (self.Size[0] - 1)/(self.Window.Size - 1)
+        y_scale = (self.Size[1] - 1)/(high - low)
+        # Right align so the newest sample is always at the right edge
+        x_offset = (self.Window.Size - length)*x_scale
+        points = []
+        for x, value in enumerate(self.Window.values()):
+            value = min(max(value, low), high)
+            points.append((x_offset + x*x_scale, self.Size[1] - 1 - (value - low)*y_scale))
+        pygame.draw.lines(self.Surface, self.Color, False, points, 2)
+
+    def render(self, surface):
+        if self.DrawnCount != self.Window.Count:
+            self.draw()
+            self.DrawnCount = self.Window.Count
+        surface.blit(self.Surface, self.Position)
+
+
+class TrendChart(object):
+    '''
+    Scrolling chart of temperature against the set point together with the
+    hot and cold valve percentages.
+
+    Each new sample scrolls the existing plot left by one column and only the
+    new column is painted, so the cost of a sample doesn't depend on how many
+    are on screen. Rendering is a single blit.
+    '''
+    def __init__(self, position, size, temp_range, column_width=2):
+        self.Position = position
+        self.Size = size
+        self.TempRange = temp_range
+        self.ColumnWidth = column_width
+        self.Font = pygame.font.SysFont("avenir", 18)
+        self.Surface = pygame.surface.Surface(self.Size)
+        self.Surface.fill(WHITE)
+        self.Legend = self.drawLegend()
+        self.Last = None
+
+    def drawLegend(self):
+        legend = pygame.surface.Surface(self.Size, pygame.SRCALPHA)
+        pygame.draw.rect(legend, BLACK, (0, 0, self.Size[0], self.Size[1]), 1)
+        x = 5
+        for name, color in (("Temp", BLACK), ("Hot %", RED), ("Cold %", BLUE), ("Set", GREEN)):
+            text = self.Font.render(name, 1, color)
+            legend.blit(text, (x, 2))
+            x += text.get_size()[0] + 10
+        return legend
+
+    def tempY(self, temperature):
+        low, high = self.TempRange
+        temperature = min(max(temperature, low), high)
+        return (self.Size[1] - 2) - (temperature - low)*(self.Size[1] - 3)/(high - low)
+
+    def percentY(self, percent):
+        percent = min(max(percent, 0), 100)
+        return (self.Size[1] - 2) - percent*(self.Size[1] - 3)/100.0
+
+    def push(self, temperature, hot, cold, set_point):
+        '''
+        Add a sample as a new column at the right of the chart. The set point
+        comes with each sample as it can change during a run.
+        '''
+        points = (self.tempY(temperature), self.percentY(hot), self.percentY(cold))
+        width = self.ColumnWidth
+        right = self.Size[0] - 1
+
+        self.Surface.scroll(-width, 0)
+        pygame.draw.rect(self.Surface, WHITE, (right - width + 1, 0, width, self.Size[1]))
+
+        set_y = self.tempY(set_point)
+        pygame.draw.line(self.Surface, GREEN, (right - width, set_y), (right, set_y))
+        if self.Last is not None:
+            for last_y, y, color in zip(self.Last, points, (BLACK, RED, BLUE)):
+                pygame.draw.line(self.Surface, color, (right - width, last_y), (right, y), 2)
+        self.Last = points
+
+    def render(self, surface):
+        surface.blit(self.Surface, self.Position)
+        surface.blit(self.Legend, self.Position)
+
+
+class DebugOverlay(object):
+    '''
+    Lines of diagnostic text over a translucent box
+    '''
+    def __init__(self, position, width):
+        self.Position = position
+        self.Width = width
+        self.Font = pygame.font.Font(None, 22)
+        self.LineHeight = self.Font.get_linesize()
+
+    def render(self, surface, lines):
+        box = pygame.surface.Surface((self.Width, self.LineHeight*len(lines) + 10), pygame.SRCALPHA)
+        box.fill((0, 0, 0, 180))
+        y = 5
+        for line in lines:
+            box.blit(self.Font.render(line, 1, WHITE), (5, y))
+            y += self.LineHeight
+        surface.blit(box, self.Position)
+
+
+class AlarmBanner(object):
+    '''
+    Red bar with the active alarms. messages returns the current ones.
+    '''
+    def __init__(self, position, size, messages):
+        self.Position = position
+        self.Size = size
+        self.Messages = messages
+        self.Font = pygame.font.SysFont("avenir", 24)
+
+    def render(self, surface):
+        messages = self.Messages()
+        if not messages:
+            return
+        text = messages[0]
+        if len(messages) > 1:
+            text += "  (+%d more)" % (len(messages) - 1)
+        pygame.draw.rect(surface, RED, (self.Position, self.Size))
+        txt_surface = self.Font.render(text, 1, WHITE)
+        surface.blit(txt_surface, (self.Position[0] + 10,
+                                   self.Position[1] + (self.Size[1] - txt_surface.get_height())/2))